@@ -1,14 +1,28 @@
-import pandas as pd
 import requests
 import time
 import json
 import os
 import smtplib
+import sqlite3
 import logging
 from datetime import datetime
+from metrics import Metrics, run_profiled
 
 # Working version - saving to TXT files
 
+# base address of UM Warszawa API, set UM_API_URL to use e.g. mock_api_server.py instead
+API_URL = os.environ.get('UM_API_URL', 'https://api.um.warszawa.pl/api/action/')
+
+# instrumentation settings
+METRICS_FILE = 'PositionsMetrics.json'  # per-stage timers and counters, saved after every poll
+METRICS_PORT = None  # e.g. 9102 to serve metrics at http://localhost:9102/metrics
+PROFILE_FILE = None  # e.g. 'PositionsProfile.prof' to dump cProfile stats when the script ends
+
+# database queried by the analyses, None disables it
+DB_FILE = 'transport.sqlite'
+
+metrics = Metrics('positions_collector')
+
 def set_API(API_KEY, resource_id):
     vehicle_type = input('Insert "1" for buses or "2" for trams ') #API link parameter
     if vehicle_type == 1:
@@ -16,10 +30,10 @@ def set_API(API_KEY, resource_id):
     else:
         set_API.prefix = 'trams_'
     set_API.target_time = datetime.strptime(input('Until when to collect data? (please input datetime in format: YYYY-MM-DD HH:MM:SS) - default: till the end of year 2023 ') or '2023-12-31 23:59:59', '%Y-%m-%d %H:%M:%S') #Datetime to which the while lopp will run
-    print('https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id=%20' + resource_id \
+    print(API_URL + 'busestrams_get/?resource_id=%20' + resource_id \
     + '&apikey=' + API_KEY \
     + '&type=' + vehicle_type)
-    set_API.link = 'https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id=%20' + resource_id \
+    set_API.link = API_URL + 'busestrams_get/?resource_id=%20' + resource_id \
     + '&apikey=' + API_KEY \
     + '&type=' + vehicle_type
 
@@ -93,54 +107,116 @@ def sendemail(gmail_user, gmail_password, sent_to):
         print('SOMETHING WENT TERRIBLY WRONG WHEN SENDING THE EMAIL! Have you provided parameters for sendmail function?')
 
 
+def poll_positions(link: str, folder: str, db=None, fleet=None) -> tuple:
+    """
+    Download current positions of vehicles and append them to an hourly txt file
+    Arguments:
+        link: busestrams_get request link
+        folder: folder for txt files
+        db: TransportDB to save positions to as well
+        fleet: FleetState (see fleet_state.py) to update with the positions
+    Returns:
+        Tuple (list of positions from the 'result' of the answer, time of download).
+        The list is empty when the API answers with an error message or
+        without vehicles, such answers aren't saved
+    """
+    with metrics.timer('request', histogram=True):
+        requested_data = requests.get(link)
+    metrics.inc('requests')
+    metrics.inc('bytes_received', len(requested_data.content))
+    with metrics.timer('parse'):
+        json_dictionary = requested_data.json()
+        positions = json_dictionary['result']
+    current_time = datetime.now().replace(microsecond=0)
+    # the API answers with an error message (a string) instead of a list
+    if not isinstance(positions, list) or not positions:
+        metrics.inc('empty_answers')
+        logging.getLogger(__name__).error(f'No positions in the answer: {str(positions)[:200]}')
+        return [], current_time
+    metrics.inc('positions', len(positions))
+    file_name = 'trams_' + str(current_time.year) + '_' + str(current_time.month) + '_' + str(current_time.day) + '_' + str(current_time.hour) + '.txt'
+    with metrics.timer('write'):
+        with open(os.path.join(folder, file_name), 'a') as f:
+            f.write(str(current_time) + '\n')
+            json.dump(json_dictionary, f)
+            f.write('\n\n')
+    # the txt file is the source of truth, a failed copy to the database or fleet state doesn't stop polling
+    if db is not None:
+        try:
+            with metrics.timer('db_write'):
+                db.insert_positions(positions)
+        except (sqlite3.Error, ValueError, TypeError, KeyError) as err:
+            metrics.inc('db_errors')
+            logging.getLogger(__name__).error(f'Positions not saved to the database: {err!r}')
+    if fleet is not None:
+        try:
+            with metrics.timer('fleet_update'):
+                metrics.inc('fleet_updates', fleet.update(positions))
+        except (ValueError, TypeError, KeyError, AttributeError) as err:
+            metrics.inc('fleet_errors')
+            logging.getLogger(__name__).error(f'Fleet state not updated: {err!r}')
+    return positions, current_time
+
+
 def run_script():
     API_KEY = load_api_key()
     set_API(API_KEY, resource_id = 'f2e5503e-927d-4ad3-9500-4ab9e55deb59')
     requested_data = requests.get(set_API.link)
     json_dictionary = requested_data.json()
-    df = pd.json_normalize(json_dictionary['result'])
-
 
-    current_time = datetime.strptime(df['Time'][0], '%Y-%m-%d %H:%M:%S')
+    # only the time of the first position is needed, no dataframe is made
+    current_time = datetime.strptime(json_dictionary['result'][0]['Time'], '%Y-%m-%d %H:%M:%S')
     base_folder = input('Wskaż folder zapisu danych: ') or str(os.getcwd()) #By default it gets the project's directory
     logs = logging.getLogger(__name__)
     logs = init_logging(logs, 'PositionsLog.log')
     logs.info('Rozpoczęcie zbierania danych...')
+    metrics_file = os.path.abspath(METRICS_FILE) # the script changes CWD later on
+    db = None
+    if DB_FILE is not None:
+        # imported only when needed, it brings pandas along
+        from transport_db import TransportDB
+        db = TransportDB(os.path.abspath(DB_FILE))
+    # live state of vehicles, other threads read it with run_script.fleet.snapshot()
+    from fleet_state import FleetState
+    run_script.fleet = FleetState()
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
     os.makedirs(os.path.join(base_folder, str(current_time.month) + '_' + str(current_time.year)), exist_ok = True) #Create a directory named 'MONTH_YEAR' in the set CWD
     os.chdir((os.path.join(base_folder, str(current_time.month) + '_' + str(current_time.year))))
     cwd = os.getcwd()
 
     while current_time < set_API.target_time:
         try:
-            requested_data = requests.get(set_API.link)
-            json_dictionary = requested_data.json()
-            df = pd.json_normalize(json_dictionary['result'])
-            current_time = datetime.now().replace(microsecond=0)
-            file_name = 'trams_' + str(current_time.year) + '_' + str(current_time.month) + '_' + str(current_time.day) + '_' + str(current_time.hour) + '.txt'
-            with open(os.path.join(cwd, file_name), 'a') as f:
-                f.write(str(current_time) + '\n')
-                json.dump(json_dictionary, f)
-                f.write('\n\n')
-                f.close()
-                time.sleep(30)
-                new_time = datetime.strptime(df['Time'].iloc[-1], '%Y-%m-%d %H:%M:%S')
-                if new_time.day != current_time.day:
-                    os.chdir(base_folder)
-                    os.makedirs(os.path.join(base_folder, str(new_time.month) + '_' + str(new_time.year)), exist_ok = True)
-                    os.chdir((os.path.join(base_folder, str(new_time.month) + '_' + str(new_time.year))))
-                    cwd = os.getcwd()
+            positions, current_time = poll_positions(set_API.link, cwd, db, run_script.fleet)
+            metrics.write_json(metrics_file)
+            time.sleep(30)
+            if not positions:
+                continue
+            new_time = datetime.strptime(positions[-1]['Time'], '%Y-%m-%d %H:%M:%S')
+            if new_time.day != current_time.day:
+                os.chdir(base_folder)
+                os.makedirs(os.path.join(base_folder, str(new_time.month) + '_' + str(new_time.year)), exist_ok = True)
+                os.chdir((os.path.join(base_folder, str(new_time.month) + '_' + str(new_time.year))))
+                cwd = os.getcwd()
         except AttributeError as err:
+            metrics.inc('errors')
             logs.error('Attribute error occurred! ' + str(err))
         except (ConnectionError, TimeoutError) as err:
+            metrics.inc('errors')
             logs.error('Connection error occurred! ' + str(err))
         except OSError as err:
+            metrics.inc('errors')
             logs.error('OS error occurred! ' + str(err))
         except NotImplementedError as err:
+            metrics.inc('errors')
             logs.error('NotImplementedError Error occurred! ' + str(err))
         except KeyError as err:
+            metrics.inc('errors')
             logs.error('Key Error occurred! ' + str(err))
         except Exception:
+            metrics.inc('errors')
             sendemail(gmail_user, gmail_password, send_to) # provide your email credentials along with specific app password
             continue
 
-run_script()
+if __name__ == '__main__':
+    run_profiled(run_script, PROFILE_FILE)
@@ -1,19 +1,49 @@
-import pandas as pd
+from __future__ import annotations
+
+# pandas, tqdm, func_timeout and modules built on pandas are imported only
+# when a download starts, the scheduler waits for it without them
 import requests
 import gc
-import tqdm
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 import os
 import smtplib
-import func_timeout
-import schedule
 from typing import Any, Callable
+from metrics import Metrics, run_profiled
+from payloads import decode_columns, decode_table, loads
+from response_cache import ResponseCache, strip_api_key
+from crawl_journal import CrawlJournal
+
+# base address of UM Warszawa API, set UM_API_URL to use e.g. mock_api_server.py instead
+API_URL = os.environ.get('UM_API_URL', 'https://api.um.warszawa.pl/api/action/')
+
+# seconds to wait before asking again after an improper answer
+RETRY_WAIT = 60
+
+# time of the daily download (HH:MM)
+RUN_AT = '13:52'
+
+# instrumentation settings
+METRICS_FILE = 'StopsMetrics.json'  # per-stage timers and counters, saved after every run
+METRICS_PORT = None  # e.g. 9101 to serve metrics at http://localhost:9101/metrics
+PROFILE_FILE = None  # e.g. 'StopsProfile.prof' to dump cProfile stats of every run
 
-# disable SettingWithCopyWarning
-pd.options.mode.chained_assignment = None
+# API answers cache settings
+CACHE_FILE = 'StopsCache.sqlite'  # None disables the cache
+CACHE_TTL = 12 * 3600  # seconds, answers from the previous day's run are downloaded again
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # least recently used answers are evicted above this size
+CACHE_OFFLINE = False  # replay cached answers only, never call the API
+
+# journal of downloaded timetables, lets an interrupted download resume where it stopped
+JOURNAL_FILE = 'rozklady_{date}.journal.sqlite'
+
+# database queried by the analyses, None disables it
+DB_FILE = 'transport.sqlite'
+
+metrics = Metrics('stops_collector')
+cache = None  # opened by run_script, so importing the script doesn't create CACHE_FILE
 
 def sendemail(gmail_user, gmail_password, send_to):
     #body = get_data_from_link.err.__class__.__name__ + ' occured at ' + str(
@@ -47,12 +77,28 @@ def get_data_from_link(link: str) -> dict:
         A dictionary in JSON format, which will be used for creating dataframes
     """
 
+    # answer from the cache, if there is one
+    if cache is not None:
+        content = cache.get(link)
+        if content is not None:
+            metrics.inc('cache_hits')
+            return loads(content)
+        if cache.offline:
+            raise LookupError(f'No cached answer for {strip_api_key(link)} in offline mode')
+        metrics.inc('cache_misses')
+
     def make_json_dictionary() -> dict:
         """
         Output a JSON dictionary based on a link
         """
-        requested_data = requests.get(link)
-        return requested_data.json()
+        with metrics.timer('request', histogram=True):
+            requested_data = requests.get(link)
+        metrics.inc('requests')
+        metrics.inc('bytes_received', len(requested_data.content))
+        make_json_dictionary.content = requested_data.content
+
+        with metrics.timer('parse'):
+            return loads(requested_data.content)
 
     def run_function(f: Callable, max_wait: int, default_value: Any):
         """
@@ -65,10 +111,12 @@ def get_data_from_link(link: str) -> dict:
             Output of make_json_dictionary function or 'default_value'
 
         """
+        import func_timeout
+
         try:
             return func_timeout.func_timeout(max_wait, make_json_dictionary)
         except func_timeout.FunctionTimedOut:
-            pass
+            metrics.inc('timeouts')
         return default_value
 
     for i in range(1, 6):
@@ -99,9 +147,10 @@ def get_data_from_link(link: str) -> dict:
                 type(json_dictionary['result']) == type([])):
             break
         else:
+            metrics.inc('retries')
             logs.error(
-                f'Failed at generating proper json_dictionary object. Attempt {i} of 5. Waiting for 60 seconds...')
-            time.sleep(60)
+                f'Failed at generating proper json_dictionary object. Attempt {i} of 5. Waiting for {RETRY_WAIT} seconds...')
+            time.sleep(RETRY_WAIT)
 
     if json_dictionary == None:
         logs.error(f"Serious lag on UM Warszawa API's end")
@@ -121,6 +170,10 @@ def get_data_from_link(link: str) -> dict:
         sendemail(gmail_user, gmail_password, send_to) # provide your email credentials along with specific app password
         exit()
 
+    # save only proper answers
+    if cache is not None:
+        cache.put(link, make_json_dictionary.content)
+
     return json_dictionary
 
 
@@ -133,31 +186,24 @@ def make_stops_table(API_KEY: str) -> pd.DataFrame:
         Dataframe with data like geo coordinates of stops
     """
     # info about stops from current day
-    stops_link = 'https://api.um.warszawa.pl/api/action/dbstore_get/?id=1c08a38c-ae09-46d2-8926-4f9d25cb0630&apikey=' \
+    stops_link = API_URL + 'dbstore_get/?id=1c08a38c-ae09-46d2-8926-4f9d25cb0630&apikey=' \
                  + API_KEY
 
     # make a request for the API
     json_dictionary = get_data_from_link(stops_link)
 
-    # create dataframe
-    df = pd.json_normalize(json_dictionary['result'])
-
-    # all values are in a format:
-    # {'value': '01', 'key': 'slupek'},
-    # {'value': 'Kijowska', 'key': 'nazwa_zespolu'},
-    # {'value': '2201', 'key': 'id_ulicy'},
-    # ...
+    # the first dataframe of a download is made here
+    import pandas as pd
+    pd.options.mode.chained_assignment = None  # disable SettingWithCopyWarning
 
-    # get column names based on keys from first observation
-    column_names = df['values'].apply(pd.Series).iloc[0].apply(lambda x: x.get('key')).tolist()
-
-    # apply column names to dataframe
-    df = df['values'].apply(pd.Series)
-    df.columns = column_names
-
-    # get values from dictionary and use them as values in dataframe
-    for col in column_names:
-        df[col] = df[col].apply(lambda x: x.get('value'))
+    with metrics.timer('assemble'):
+        # all values are in a format:
+        # {'value': '01', 'key': 'slupek'},
+        # {'value': 'Kijowska', 'key': 'nazwa_zespolu'},
+        # {'value': '2201', 'key': 'id_ulicy'},
+        # ...
+        # column names are taken from keys of the first observation
+        df = decode_table(json_dictionary['result'])
 
     return df
 
@@ -172,7 +218,9 @@ def add_lines_to_stops_table(df: pd.DataFrame, API_KEY: str) -> pd.DataFrame:
         Original dataframe but with an extra column ('linie') containing every
         line for every stop
     """
-    df['linie'] = None  # insert empty column
+    import tqdm
+
+    lines_column = []
 
     # for every entry make a request about stop informations
     for index, row in tqdm.tqdm(df[['zespol', 'slupek']].iterrows(), total=df.shape[0]):
@@ -181,16 +229,18 @@ def add_lines_to_stops_table(df: pd.DataFrame, API_KEY: str) -> pd.DataFrame:
         zespol = row['zespol']
         slupek = row['slupek']
 
-        link = 'https://api.um.warszawa.pl/api/action/dbtimetable_get/?id=88cd555f-6f31-43ca-9de4-66c479ad5942&busstopId=' \
+        link = API_URL + 'dbtimetable_get/?id=88cd555f-6f31-43ca-9de4-66c479ad5942&busstopId=' \
                + zespol + '&busstopNr=' + slupek + '&apikey=' + API_KEY
 
         json_dictionary = get_data_from_link(link)
 
         # transform the information into line numbers
-        lines = [elem.get('values')[0].get('value') for elem in json_dictionary['result']]
+        lines = decode_columns(json_dictionary['result'], keys=['linia'])['linia']
 
-        # insert line numbers into the dataframe
-        df.loc[index, 'linie'] = lines
+        lines_column.append(lines)
+
+    # insert line numbers into the dataframe
+    df['linie'] = lines_column
 
     # leave only active stops and discard the rest
     df = df[df['linie'].map(lambda x: len(x) > 0)]
@@ -198,7 +248,8 @@ def add_lines_to_stops_table(df: pd.DataFrame, API_KEY: str) -> pd.DataFrame:
     return df
 
 
-def make_timetables_for_lines(df: pd.DataFrame, API_KEY: str, only_trams: bool = False) -> pd.DataFrame:
+def make_timetables_for_lines(df: pd.DataFrame, API_KEY: str, only_trams: bool = False,
+                              journal: CrawlJournal = None) -> pd.DataFrame:
     """
     Send a request to every line number on every stop about the timetable for
     that particulat line on that particular stop
@@ -206,25 +257,21 @@ def make_timetables_for_lines(df: pd.DataFrame, API_KEY: str, only_trams: bool =
         df: DataFrame with stops data one line numbers (with the extra column 'linie)
         API_KEY: api key from credentials.json
         only_trams: do we want data only for trams or for all types of vehicles
+        journal: journal of already downloaded timetables, they are taken from
+        the journal instead of the API and every new one is saved to it
     Return:
         Table with every timetable for every line in every stop
     """
 
-    # set a vehicle type based on its number
-    df[
-        'typ'] = 'A'  # first assign 'A' to all types of vehicles
+    import tqdm
+    from line_registry import classify_line
 
-    df.loc[df['linie'].apply(lambda x: str(x[0])[0] == 'W'), 'typ'] = 'WKD'  # assign WKD label
-    df.loc[df['linie'].apply(lambda x: str(x[0])[0] == 'R'), 'typ'] = 'R'  # assign KM train label
-    df.loc[df['linie'].apply(lambda x: str(x[0])[0] == 'S'), 'typ'] = 'S'  # assign SKM train label
-    df.loc[df['linie'].apply(lambda x: str(x[0])[0] == 'M'), 'typ'] = 'M'  # assign metro train label
+    # set a vehicle type based on the number of the first line at a stop,
+    # every distinct line is classified only once
+    first_lines = df['linie'].str[0]
+    df['typ'] = first_lines.map({line: classify_line(line) for line in first_lines.unique()})
     df = df.reset_index()
 
-    # find the rows, that have 'A' and their length isn't greater then 2
-    less_then_2_index = df[(df.typ == 'A') & (df.linie.apply(lambda x: len(x[0]) <= 2))].index.tolist()
-
-    df.loc[less_then_2_index, 'typ'] = 'T'  # assign tram label
-
     # restrict dataframe to only trams in onlty_trams == True
     if only_trams:
         df = df[df['typ'] == 'T']
@@ -241,22 +288,33 @@ def make_timetables_for_lines(df: pd.DataFrame, API_KEY: str, only_trams: bool =
         brygada_list = []
         trasa_list = []
         for linia in linie:
-            link = 'https://api.um.warszawa.pl/api/action/dbtimetable_get/?id=e923fa0e-d96c-43f9-ae6e-60518c9f3238&busstopId=' \
+            # skip timetables downloaded before an interruption
+            unit = journal.get(zespol, slupek, linia) if journal is not None else None
+            if unit is not None:
+                metrics.inc('journal_hits')
+                czas, brygada, trasa = unit
+                czas_list.append(czas)
+                brygada_list.append(brygada)
+                trasa_list.append(trasa)
+                continue
+
+            link = API_URL + 'dbtimetable_get/?id=e923fa0e-d96c-43f9-ae6e-60518c9f3238&busstopId=' \
                    + zespol + '&busstopNr=' + slupek + '&line=' + linia + '&apikey=' + API_KEY
 
             # make request to the API
             json_dictionary = get_data_from_link(link)
 
-            # get timetable for line number 'linia'
-            czas = tuple(d['value'] for d in
-                         [json_dictionary['result'][n].get('values')[5] for n in range(len(json_dictionary['result']))])
-            brygada = tuple(d['value'] for d in \
-                [json_dictionary['result'][n].get('values')[2] for n in range(len(json_dictionary['result']))])
-            trasa = tuple(d['value'] for d in  \
-                [json_dictionary['result'][n].get('values')[4] for n in range(len(json_dictionary['result']))])
+            with metrics.timer('assemble'):
+                # get timetable for line number 'linia'
+                columns = decode_columns(json_dictionary['result'], keys=['brygada', 'trasa', 'czas'])
+                brygada = tuple(columns['brygada'])
+                trasa = tuple(columns['trasa'])
+
+                # delete seconds from timetable
+                czas = tuple(elem[:-3] for elem in columns['czas'])
 
-            # delete seconds from timetable
-            czas = tuple([elem[:-3] if len(czas) >= 1 else elem for elem in czas])
+            if journal is not None:
+                journal.put(zespol, slupek, linia, czas, brygada, trasa)
             czas_list.append(czas)
             brygada_list.append(brygada)
             trasa_list.append(trasa)
@@ -342,32 +400,97 @@ def run_script():
         logs = logging.getLogger(__name__)
         logs = init_logging(logs, 'StopsLog.log')
 
+        global cache
+        if cache is None and CACHE_FILE is not None:
+            cache = ResponseCache(CACHE_FILE, CACHE_TTL, CACHE_MAX_BYTES, CACHE_OFFLINE)
+
         # get API key
         API_KEY = load_api_key()
 
         logs.info('Downloading basic stops information...')
-        df = make_stops_table(API_KEY)
+        with metrics.timer('stage_stops_table'):
+            df = make_stops_table(API_KEY)
 
         logs.info('Downloading line numbers for stops...')
-        df = add_lines_to_stops_table(df, API_KEY)
+        with metrics.timer('stage_lines'):
+            df = add_lines_to_stops_table(df, API_KEY)
+
+        journal_file_name = JOURNAL_FILE.format(date=run_script.now)
+        journal = CrawlJournal(journal_file_name)
+        if len(journal) > 0:
+            logs.info(f'Resuming download, {len(journal)} timetables are already in {journal_file_name}')
 
         logs.info('Downloading timetables for all lines...')
-        df = make_timetables_for_lines(df, API_KEY, only_trams=only_trams)
+        with metrics.timer('stage_timetables'):
+            df = make_timetables_for_lines(df, API_KEY, only_trams=only_trams, journal=journal)
+        journal.close()
 
-        logs.info(f'Saving data to rozklady_{run_script.now}.pkl')
+        logs.info(f'Saving data to rozklady_{run_script.now}/')
         try:
-            df.to_pickle(f'rozklady_{run_script.now}.pkl', compression='zip')
+            with metrics.timer('write'):
+                from snapshot_store import write_snapshot
+                write_snapshot(df, f'rozklady_{run_script.now}')
         except Exception as err:
             logs.error(err)
+        else:
+            from line_registry import REGISTRY_FILE, LineRegistry
+
+            logs.info(f'Saving line metadata to {REGISTRY_FILE.format(date=run_script.now)}')
+            with metrics.timer('registry'):
+                LineRegistry.from_timetables(df).save(REGISTRY_FILE.format(date=run_script.now))
+
+            if DB_FILE is not None:
+                logs.info(f'Saving stops and timetables to {DB_FILE}')
+                with metrics.timer('db_write'):
+                    from transport_db import TransportDB
+                    db = TransportDB(DB_FILE)
+                    db.insert_snapshot(run_script.now, df)
+                    db.close()
+
+            # the journal is needed only until the timetables are saved
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(journal_file_name + suffix):
+                    os.remove(journal_file_name + suffix)
+
+        logs.info(f'Saving metrics to {METRICS_FILE}')
+        metrics.write_json(METRICS_FILE)
 
         logs.info('Deleting unnecessary data from memory...')
         del df
         gc.collect()
 
-        logs.info('Download completed. The script will restart at 10:00')
+        logs.info(f'Download completed. The script will restart at {RUN_AT}')
 
-print('The script will start running every day at 10:00 ...')
-schedule.every().day.at("13:52").do(run_script)
 
-while True:
-    schedule.run_pending()
+def run_every_day(at: str, f: Callable, *args):
+    """
+    Run a function every day at a given time, sleeping in between
+    Arguments:
+        at: time of day ('HH:MM')
+        f: function to run
+        args: arguments of the function
+    """
+    hour, minute = map(int, at.split(':'))
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+
+        # sleep at most an hour at once, so a changed system clock is noticed
+        while (remaining := (next_run - datetime.now()).total_seconds()) > 0:
+            time.sleep(min(remaining, 3600))
+
+        f(*args)
+
+if __name__ == '__main__':
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
+
+    # finish a download interrupted earlier today right away
+    if os.path.exists(JOURNAL_FILE.format(date=datetime.now().strftime("%Y-%m-%d"))):
+        print('Resuming an interrupted download...')
+        run_profiled(run_script, PROFILE_FILE)
+
+    print(f'The script will start running every day at {RUN_AT} ...')
+    run_every_day(RUN_AT, run_profiled, run_script, PROFILE_FILE)
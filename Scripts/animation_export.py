@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+import folium
+from folium import plugins
+
+from constants import TRAM_ICON
+from trajectories import snap_to_routes
+
+# default length of a time grid step and default simplification tolerance
+TIME_GRID_PERIOD = '30s'
+SIMPLIFY_TOLERANCE = 15.0  # meters
+
+
+def bin_to_time_grid(df: pd.DataFrame, period: str = TIME_GRID_PERIOD) -> pd.DataFrame:
+    """
+    Resample trajectories onto a fixed time grid
+    Arguments:
+        df: dataframe with 'VehicleNumber' and 'Time' columns sorted by both
+        period: length of one grid step, e.g. '30s' or '1min'
+    Returns:
+        Dataframe with at most one fix per vehicle and grid step (the latest
+        one) and 'Time' moved onto the grid
+    """
+    df = df.assign(Time=df['Time'].dt.floor(period))
+    return df.drop_duplicates(subset=['VehicleNumber', 'Time'], keep='last')
+
+
+def douglas_peucker(t: np.ndarray, s: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Simplify a single trajectory with the Douglas-Peucker algorithm
+    Arguments:
+        t: times of fixes (in seconds), increasing
+        s: chainage of fixes (in meters)
+        tolerance: maximal error (in meters) of the simplified trajectory
+    Returns:
+        Boolean mask of fixes to keep. The error of a fix is measured as the
+        distance between its chainage and the chainage interpolated at the same
+        time between the kept neighbours, so stops at tram stops are preserved
+    """
+    n = len(t)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[[0, n - 1]] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        inner_t = t[first + 1:last]
+        if t[last] == t[first]:
+            expected = np.full(inner_t.shape, s[first])
+        else:
+            expected = s[first] + (s[last] - s[first]) * (inner_t - t[first]) / (t[last] - t[first])
+        errors = np.abs(s[first + 1:last] - expected)
+
+        worst = int(np.argmax(errors))
+        if errors[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return keep
+
+
+def simplify_trajectories(df: pd.DataFrame, tolerance: float = SIMPLIFY_TOLERANCE) -> pd.DataFrame:
+    """
+    Simplify trajectories of every vehicle
+    Arguments:
+        df: dataframe with 'VehicleNumber', 'Time' and 'Chainage' columns
+        sorted by 'VehicleNumber' and 'Time'
+        tolerance: maximal error (in meters) of simplified trajectories
+    Returns:
+        Dataframe restricted to fixes needed to redraw the trajectories
+    """
+    t = df['Time'].to_numpy(dtype='datetime64[s]').astype(np.int64).astype(float)
+    s = df['Chainage'].to_numpy(dtype=float)
+
+    # boundaries between vehicles in the sorted dataframe
+    vehicles = df['VehicleNumber'].to_numpy()
+    bounds = np.flatnonzero(vehicles[1:] != vehicles[:-1]) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(df)]])
+
+    keep = np.zeros(len(df), dtype=bool)
+    for start, end in zip(starts, ends):
+        keep[start:end] = douglas_peucker(t[start:end], s[start:end], tolerance)
+
+    return df[keep]
+
+
+def make_features(df: pd.DataFrame, color: str = 'red', icon: str = TRAM_ICON,
+                  lon_col: str = 'SnappedLon', lat_col: str = 'SnappedLat') -> list:
+    """
+    Make one TimestampedGeoJson feature per vehicle
+    Arguments:
+        df: dataframe with 'VehicleNumber', 'Lines', 'Brigade' and 'Time'
+        columns sorted by 'VehicleNumber' and 'Time'
+        color: color of lines
+        icon: url of a marker icon, None for a default marker
+        lon_col, lat_col: names of columns with coordinates
+    Returns:
+        List of GeoJSON features
+    """
+    if df.empty:
+        return []
+
+    # convert all columns at once, coordinates rounded to about 1 meter
+    coordinates = np.round(df[[lon_col, lat_col]].to_numpy(dtype=float), 5).tolist()
+    dates = df['Time'].dt.strftime('%Y-%m-%dT%H:%M:%S').tolist()
+
+    vehicles = df['VehicleNumber'].to_numpy()
+    starts = np.concatenate([[0], np.flatnonzero(vehicles[1:] != vehicles[:-1]) + 1]).tolist()
+    ends = starts[1:] + [len(df)]
+    lines = df['Lines'].to_numpy()[starts].tolist()
+    brigades = df['Brigade'].to_numpy()[starts].tolist()
+
+    properties = {"style": {"color": color}, "icon": "marker"}
+    if icon is not None:
+        properties["iconstyle"] = {"iconUrl": icon, "iconSize": [40, 40]}
+
+    return [
+        {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": coordinates[start:end],
+            },
+            "properties": {
+                "times": dates[start:end],
+                "popup": f'{line}/{brigade}',
+                **properties,
+            },
+        }
+        for start, end, line, brigade in zip(starts, ends, lines, brigades)
+    ]
+
+
+def prepare_trajectories(df: pd.DataFrame, routes: dict, period: str = TIME_GRID_PERIOD,
+                         tolerance: float = SIMPLIFY_TOLERANCE) -> pd.DataFrame:
+    """
+    Snap, resample and simplify GPS positions for an animation
+    Arguments:
+        df: dataframe made with load_gps_positions
+        routes: dictionary made with load_routes
+        period: length of one time grid step
+        tolerance: maximal error (in meters) of simplified trajectories
+    Returns:
+        Dataframe with only the fixes that are drawn on the map
+    """
+    df_s = snap_to_routes(df, routes)
+    df_s = bin_to_time_grid(df_s, period)
+    return simplify_trajectories(df_s, tolerance)
+
+
+def animate_fleet(df: pd.DataFrame, routes: dict, period: str = TIME_GRID_PERIOD,
+                  tolerance: float = SIMPLIFY_TOLERANCE, m: folium.Map = None) -> folium.Map:
+    """
+    Visualize moving vehicles of many lines and brigades on one map
+    Arguments:
+        df: dataframe made with load_gps_positions
+        routes: dictionary made with load_routes
+        period: length of one time grid step
+        tolerance: maximal error (in meters) of simplified trajectories
+        m: map to draw on, None creates a new one
+    Returns:
+        Dynamic map with lines indicating movement of every vehicle
+    """
+    df_a = prepare_trajectories(df, routes, period, tolerance)
+
+    # create folium map zooming in on the mean position
+    if m is None:
+        m = folium.Map(location=[df_a['SnappedLat'].mean(), df_a['SnappedLon'].mean()], zoom_start=12)
+
+        # add geocoder (textbox to input geolocation names)
+        plugins.Geocoder().add_to(m)
+
+    plugins.TimestampedGeoJson(
+        {
+            "type": "FeatureCollection",
+            "features": make_features(df_a),
+        },
+        period='PT' + str(int(pd.Timedelta(period).total_seconds())) + 'S',
+        add_last_point=True,
+    ).add_to(m)
+
+    return m
@@ -0,0 +1,301 @@
+'''
+Batch driver of the load -> clean -> snap -> delay pipeline over ranges of
+days and sets of lines, e.g. the whole tram network in January 2023:
+
+    python batch_pipeline.py --start 2023-01-01 --end 2023-01-31 --workers 8
+
+Every (day, line) unit is written to DELAYS_FOLDER/day=YYYY-MM-DD/line=N/
+together with a fingerprint of its inputs, units with unchanged inputs are
+skipped when the command is run again.
+'''
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+
+import pandas as pd
+
+from constants import DELAYS_FOLDER, GPS_POSITIONS_FOLDER, ROUTES_GEOMETRY_FILE, TIMETABLES_FOLDER
+from delays import CHAINAGE_COLUMNS, compute_delays, misordered_stops, route_stop_chainages
+from line_registry import LineRegistry, registry_file_name
+from positions_archive import archive_file_names
+from snapshot_store import SNAPSHOT_META_FILE, is_snapshot, read_departures, read_stops
+from timetables import explode_timetables, load_timetables
+from trajectories import load_gps_positions, load_routes, position_files_for_day, snap_to_routes
+
+RESULT_FILE = 'delays.csv'
+FINGERPRINT_FILE = '_fingerprint'
+
+# stops along routes of a snapshot, saved next to it (inside a snapshot folder)
+CHAINAGES_FILE = 'chainages_{date}.csv'
+
+# change it when the pipeline gives different results for the same inputs, so old units are recomputed
+PIPELINE_VERSION = '2'
+
+
+def timetables_for_day(day: date, timetables_folder: str) -> str:
+    """
+    Find the latest timetables snapshot (rozklady_YYYY-MM-DD folder made with
+    snapshot_store.write_snapshot, .pkl or .csv) downloaded on or before a given day
+    Returns:
+        File name or None if there is no such snapshot
+    """
+    snapshots = {}
+    for file_name in sorted(glob.glob(os.path.join(timetables_folder, 'rozklady_*'))):
+        found = re.search(r'rozklady_(\d{4}-\d{2}-\d{2})(\.pkl|\.csv)?$', file_name)
+        if found is None or found.group(2) is None and not is_snapshot(file_name):
+            continue
+        if date.fromisoformat(found.group(1)) <= day:
+            snapshots.setdefault(found.group(1), file_name)
+    return snapshots[max(snapshots)] if snapshots else None
+
+
+def load_snapshot(file_name: str, lines: list = None) -> tuple:
+    """
+    Load departures and stop coordinates from a timetables snapshot
+    Arguments:
+        file_name: snapshot folder or file
+        lines: line numbers, None loads every line. Only their partitions of
+               a snapshot folder are read
+    Returns:
+        Tuple (departures made with timetables.explode_timetables, stops with
+        'zespol', 'slupek', 'szer_geo' and 'dlug_geo' columns)
+    """
+    if is_snapshot(file_name):
+        return read_departures(file_name, lines), read_stops(file_name, ['zespol', 'slupek', 'szer_geo', 'dlug_geo'])
+
+    df = load_timetables(file_name)
+    if 'szer_geo' in df:
+        stops = df[['zespol', 'slupek', 'szer_geo', 'dlug_geo']]
+    else:
+        # timetables without coordinates come with a stops file from the same day
+        stops = pd.read_pickle(file_name.replace('rozklady_', 'przystanki_')[:-4] + '.pkl', compression='zip')
+        stops = stops[['zespol', 'slupek', 'szer_geo', 'dlug_geo']]
+    stops = stops.astype({'zespol': str, 'slupek': str}).drop_duplicates(['zespol', 'slupek'])
+    return explode_timetables(df), stops
+
+
+def line_registry(timetables_file: str) -> LineRegistry:
+    """
+    Get metadata of lines of a timetables snapshot, saved next to it by
+    API_get_stops.py. Older snapshots get it built and saved on first use
+    """
+    file_name = registry_file_name(timetables_file)
+    if os.path.exists(file_name):
+        return LineRegistry.load(file_name)
+
+    registry = LineRegistry.from_departures(load_snapshot(timetables_file)[0])
+    registry.save(file_name)
+    return registry
+
+
+def snapshot_input_file(timetables_file: str) -> str:
+    """
+    Get the file which changes whenever a timetables snapshot changes, a
+    snapshot folder is written with its meta file last
+    """
+    if is_snapshot(timetables_file):
+        return os.path.join(timetables_file, SNAPSHOT_META_FILE)
+    return timetables_file
+
+
+def chainages_file_name(timetables_file: str) -> str:
+    day = re.search(r'rozklady_(\d{4}-\d{2}-\d{2})', timetables_file).group(1)
+    folder = timetables_file if is_snapshot(timetables_file) else os.path.dirname(timetables_file)
+    return os.path.join(folder, CHAINAGES_FILE.format(date=day))
+
+
+def route_chainages(timetables_file: str, routes_file: str, lines: list = None) -> pd.DataFrame:
+    """
+    Get stops along every (line, route code) of a timetables snapshot, see
+    delays.route_stop_chainages. They're computed once per snapshot and route
+    geometry and cached next to the snapshot
+    Arguments:
+        timetables_file: timetables snapshot
+        routes_file: txt file with route geometry
+        lines: line numbers, None gives every line
+    Returns:
+        Dataframe with delays.CHAINAGE_COLUMNS
+    """
+    file_name = chainages_file_name(timetables_file)
+    cache_fingerprint = fingerprint([snapshot_input_file(timetables_file), routes_file])
+    try:
+        with open(file_name + FINGERPRINT_FILE) as f:
+            up_to_date = f.read() == cache_fingerprint
+    except FileNotFoundError:
+        up_to_date = False
+
+    if up_to_date:
+        chainages = pd.read_csv(file_name, dtype={'linia': str, 'trasa': str, 'zespol': str, 'slupek': str})
+    else:
+        departures, stops = load_snapshot(timetables_file)
+        chainages = route_stop_chainages(departures, stops, load_routes(routes_file),
+                                         registry=line_registry(timetables_file))
+        misordered = misordered_stops(chainages, departures)
+        if not misordered.empty:
+            print(f'{file_name}: {len(misordered)} stops of {misordered.groupby(["linia", "trasa"]).ngroups} '
+                  'route codes out of their timetable order')
+        chainages.to_csv(file_name, index=False)
+        # the fingerprint is written last, so an interrupted build is repeated
+        with open(file_name + FINGERPRINT_FILE, 'w') as f:
+            f.write(cache_fingerprint)
+
+    if lines is not None:
+        chainages = chainages[chainages['linia'].isin(lines)]
+    return chainages[CHAINAGE_COLUMNS].reset_index(drop=True)
+
+
+def fingerprint(file_names: list, *extra: str) -> str:
+    """
+    Hash names, sizes and modification times of input files with other
+    parameters of a unit
+    """
+    digest = hashlib.sha1(PIPELINE_VERSION.encode())
+    for file_name in sorted(file_names):
+        stat = os.stat(file_name)
+        digest.update(f'{file_name}|{stat.st_size}|{stat.st_mtime_ns}\n'.encode())
+    for value in extra:
+        digest.update(f'{value}\n'.encode())
+    return digest.hexdigest()
+
+
+def unit_folder(output_folder: str, day: date, line: str) -> str:
+    return os.path.join(output_folder, f'day={day.isoformat()}', f'line={line}')
+
+
+def is_up_to_date(output_folder: str, day: date, line: str, unit_fingerprint: str) -> bool:
+    folder = unit_folder(output_folder, day, line)
+    try:
+        with open(os.path.join(folder, FINGERPRINT_FILE)) as f:
+            return f.read() == unit_fingerprint and os.path.exists(os.path.join(folder, RESULT_FILE))
+    except FileNotFoundError:
+        return False
+
+
+def process_day(day: date, lines: dict, timetables_file: str, positions_folder: str, routes_file: str,
+                output_folder: str) -> pd.DataFrame:
+    """
+    Run the pipeline for some lines on one day, a work unit of the process pool
+    Arguments:
+        day: day of positions
+        lines: dictionary {line: fingerprint} of lines to process
+        timetables_file: timetables snapshot valid on that day
+        positions_folder: root folder of the positions archive
+        routes_file: txt file with route geometry
+        output_folder: root folder of partitioned results
+    Returns:
+        Delays of all processed lines
+    """
+    departures, _ = load_snapshot(timetables_file, list(lines))
+    departures = departures[departures['linia'].isin(lines)]
+    routes = load_routes(routes_file, list(lines))
+    chainages = route_chainages(timetables_file, routes_file, list(lines))
+
+    df = snap_to_routes(load_gps_positions(day, positions_folder, list(lines)), routes)
+    delays = compute_delays(df, routes, departures, chainages, day.isoformat())
+
+    for line, unit_fingerprint in lines.items():
+        folder = unit_folder(output_folder, day, line)
+        os.makedirs(folder, exist_ok=True)
+        delays[delays['line'] == line].to_csv(os.path.join(folder, RESULT_FILE), index=False)
+        # the fingerprint is written last, so an interrupted unit is recomputed
+        with open(os.path.join(folder, FINGERPRINT_FILE), 'w') as f:
+            f.write(unit_fingerprint)
+
+    return delays
+
+
+def plan_units(days: list, lines: list, args: argparse.Namespace) -> dict:
+    """
+    Find (day, line) units to compute
+    Arguments:
+        days: days of positions
+        lines: line numbers, None gives tram lines of the registry of every
+               day's snapshot which have a route geometry
+        args: parsed command line arguments
+    Returns:
+        Dictionary {day: (timetables file, {line: fingerprint})} without up to date units
+    """
+    route_ids = set(load_routes(args.routes_file)) if lines is None else None
+    units = {}
+    for day in days:
+        timetables_file = timetables_for_day(day, args.timetables_folder)
+        position_files = position_files_for_day(day, args.positions_folder)
+        if not position_files:
+            position_files = [file_name for file_name in archive_file_names(day, args.positions_folder)
+                              if os.path.exists(file_name)]
+        if timetables_file is None or not position_files:
+            print(f'{day}: no timetables or positions, skipping')
+            continue
+
+        day_lines = lines
+        if day_lines is None:
+            day_lines = [line for line in line_registry(timetables_file).lines_of_type('T') if line in route_ids]
+
+        todo = {}
+        for line in day_lines:
+            unit_fingerprint = fingerprint(position_files + [snapshot_input_file(timetables_file), args.routes_file],
+                                           line)
+            if args.force or not is_up_to_date(args.output, day, line, unit_fingerprint):
+                todo[line] = unit_fingerprint
+        if todo:
+            units[day] = (timetables_file, todo)
+    return units
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Compute delays for ranges of days and sets of lines')
+    parser.add_argument('--start', type=date.fromisoformat, required=True, help='first day (YYYY-MM-DD)')
+    parser.add_argument('--end', type=date.fromisoformat, help='last day (YYYY-MM-DD), --start by default')
+    parser.add_argument('--lines', nargs='*',
+                        help='line numbers, tram lines of the line registry with a route geometry by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='recompute units which are up to date')
+    parser.add_argument('--timetables-folder', default=TIMETABLES_FOLDER)
+    parser.add_argument('--positions-folder', default=GPS_POSITIONS_FOLDER)
+    parser.add_argument('--routes-file', default=ROUTES_GEOMETRY_FILE)
+    parser.add_argument('--output', default=DELAYS_FOLDER, help='root folder of partitioned results')
+    parser.add_argument('--db', help='also save delays to this TransportDB file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    end = args.end or args.start
+    days = [args.start + timedelta(days=n) for n in range((end - args.start).days + 1)]
+    lines = [str(line) for line in args.lines] if args.lines else None
+
+    units = plan_units(days, lines, args)
+    n_units = sum(len(todo) for _, todo in units.values())
+    print(f'{n_units} (day, line) units to compute in {len(units)} days')
+
+    # stops along routes are built once per snapshot, before workers read them
+    for timetables_file in sorted({timetables_file for timetables_file, _ in units.values()}):
+        route_chainages(timetables_file, args.routes_file)
+
+    db = None
+    if args.db is not None:
+        from transport_db import TransportDB
+        db = TransportDB(args.db)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_day, day, todo, timetables_file, args.positions_folder, args.routes_file,
+                                   args.output): day
+                   for day, (timetables_file, todo) in units.items()}
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                delays = future.result()
+            except Exception as err:
+                print(f'{day}: failed with {err!r}')
+                continue
+            print(f'{day}: {len(units[day][1])} lines, {len(delays)} delays')
+            if db is not None:
+                db.insert_delays(delays)
+
+    if db is not None:
+        db.close()
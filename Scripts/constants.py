@@ -0,0 +1,15 @@
+''' This module defines project-level constants'''
+
+### Main files and folders ###
+TIMETABLES_FOLDER = 'data/Timetables/'
+GPS_POSITIONS_FOLDER = 'data/Positions/'
+ROUTES_GEOMETRY_FILE = 'data/Lines/Trams_points_vertices.txt'
+DELAYS_FOLDER = 'data/Delays/'
+
+### Coordinate systems ###
+# GPS positions and stops use longitude-latitude (WGS84), route geometry
+# files are written in a metric system (CRS 2178)
+WGS84_EPSG = 4326
+ROUTES_EPSG = 2178
+
+TRAM_ICON = "https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcTo8ghk-iBncj_HnWVMjR623u97xyVwnGLmPg&usqp=CAU"
@@ -0,0 +1,56 @@
+import json
+import sqlite3
+
+
+class CrawlJournal:
+    """
+    SQLite journal of timetables already downloaded by a crawl
+
+    Every (zespol, slupek, line) unit is committed as soon as it's downloaded,
+    so a crawl that crashed can be restarted and download only the missing
+    units.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS units (
+                                       zespol TEXT,
+                                       slupek TEXT,
+                                       linia TEXT,
+                                       czas TEXT,
+                                       brygada TEXT,
+                                       trasa TEXT,
+                                       PRIMARY KEY (zespol, slupek, linia))''')
+        self.connection.commit()
+
+        # completed units are kept in memory for fast lookups
+        self.units = {(zespol, slupek, linia): (tuple(json.loads(czas)), tuple(json.loads(brygada)),
+                                                tuple(json.loads(trasa)))
+                      for zespol, slupek, linia, czas, brygada, trasa
+                      in self.connection.execute('SELECT * FROM units')}
+
+    def __len__(self):
+        return len(self.units)
+
+    def get(self, zespol: str, slupek: str, linia: str) -> tuple:
+        """
+        Get a downloaded unit
+        Returns:
+            Tuple (czas, brygada, trasa) or None if the unit wasn't downloaded yet
+        """
+        return self.units.get((zespol, slupek, linia))
+
+    def put(self, zespol: str, slupek: str, linia: str, czas: tuple, brygada: tuple, trasa: tuple):
+        """
+        Save a downloaded unit
+        """
+        self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?)',
+                                (zespol, slupek, linia, json.dumps(czas), json.dumps(brygada), json.dumps(trasa)))
+        self.connection.commit()
+        self.units[(zespol, slupek, linia)] = (czas, brygada, trasa)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,272 @@
+'''
+Delay prediction: features from the delays table of transport.sqlite, an
+incremental on-disk feature store and a CPU model with batched inference, e.g.:
+
+    python delay_model.py --db transport.sqlite --store features/ --test-days 7
+'''
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from transport_db import TransportDB
+
+FEATURE_STORE_FOLDER = 'features/'
+MODEL_FILE = 'delay_model.npz'
+
+# categorical features are stored as fixed width strings, so files load without pickle
+CATEGORICAL_FEATURES = ['line', 'stop']
+NUMERIC_FEATURES = ['upstream_delay', 'has_upstream', 'headway', 'time_sin', 'time_cos']
+
+# change it when build_features changes, so stored days are built again
+FEATURES_VERSION = 2
+
+# hours of the day get separate intercepts
+HOURS = 24
+
+# ridge penalty of the linear part and shrinkage (in departures) of line and stop effects
+RIDGE = 1.0
+SHRINKAGE = 20
+
+# number of stop arrivals in one prediction batch
+BATCH_SIZE = 1000
+
+
+def build_features(delays: pd.DataFrame) -> pd.DataFrame:
+    """
+    Make features of departures from delays of one or more days
+    Arguments:
+        delays: dataframe with columns of the delays table of TransportDB
+    Returns:
+        Dataframe with 'day', 'line', 'stop' ('zespol_slupek'), 'scheduled',
+        'hour', numeric features and 'delay' (target, in seconds):
+        - upstream_delay: delay of the same brigade at its previous stop
+        - has_upstream: 0 at the first stop of a brigade
+        - headway: seconds from the real departure of the previous vehicle of
+          the line (by schedule) to the scheduled departure, it uses only
+          delays known before the departure
+        - time_sin, time_cos: time of day on a circle
+    """
+    df = delays.sort_values(['day', 'line', 'brigade', 'scheduled'], kind='stable').reset_index(drop=True)
+    df['delay'] = df['delay'].astype(float)
+
+    upstream = df.groupby(['day', 'line', 'brigade'])['delay'].shift()
+    df['has_upstream'] = upstream.notna().astype(float)
+    df['upstream_delay'] = upstream.fillna(0.0)
+
+    # the delay of a departure itself is the target, so only the previous vehicle's departure is used
+    df['departure'] = df['scheduled'] * 60 + df['delay']
+    df = df.sort_values(['day', 'line', 'zespol', 'slupek', 'scheduled'], kind='stable')
+    previous = df.groupby(['day', 'line', 'zespol', 'slupek'])['departure'].shift()
+    df['headway'] = df['scheduled'] * 60 - previous
+    df['headway'] = df['headway'].fillna(df['headway'].median()).fillna(0.0)
+
+    angle = 2 * np.pi * df['scheduled'] / (24 * 60)
+    df['time_sin'] = np.sin(angle)
+    df['time_cos'] = np.cos(angle)
+    df['hour'] = (df['scheduled'] // 60) % HOURS
+    df['stop'] = df['zespol'].astype(str) + '_' + df['slupek'].astype(str)
+    df['line'] = df['line'].astype(str)
+
+    return df[['day', 'line', 'stop', 'scheduled', 'hour'] + NUMERIC_FEATURES + ['delay']].reset_index(drop=True)
+
+
+class FeatureStore:
+    """
+    Folder with features of every day in a separate npz file
+
+    Features of a day are built once, re-training only reads them, and
+    delays of new days are added without touching older files.
+    """
+
+    def __init__(self, folder: str = FEATURE_STORE_FOLDER):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def file_name(self, day: str) -> str:
+        return os.path.join(self.folder, f'features_{day}.npz')
+
+    def days(self) -> list:
+        """
+        Get days in the store, sorted
+        """
+        return sorted(name[len('features_'):-len('.npz')] for name in os.listdir(self.folder)
+                      if name.startswith('features_') and name.endswith('.npz'))
+
+    def put(self, day: str, df: pd.DataFrame):
+        """
+        Save features of one day
+        """
+        arrays = {column: df[column].to_numpy(dtype=str) for column in CATEGORICAL_FEATURES}
+        arrays.update({column: df[column].to_numpy(dtype=np.float32) for column in NUMERIC_FEATURES + ['delay']})
+        arrays.update(scheduled=df['scheduled'].to_numpy(dtype=np.int16), hour=df['hour'].to_numpy(dtype=np.int8))
+        arrays.update(version=np.array(FEATURES_VERSION))
+
+        # written under a temporary name first, so a crash doesn't leave a broken day
+        temporary_name = os.path.join(self.folder, f'tmp_features_{day}.npz')
+        np.savez(temporary_name, **arrays)
+        os.replace(temporary_name, self.file_name(day))
+
+    def load(self, days: list = None) -> pd.DataFrame:
+        """
+        Load features of some days (all by default)
+        """
+        frames = []
+        for day in self.days() if days is None else days:
+            with np.load(self.file_name(day)) as arrays:
+                frames.append(pd.DataFrame({name: arrays[name] for name in arrays.files if name != 'version'})
+                              .assign(day=day))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def version(self, day: str) -> int:
+        """
+        Get FEATURES_VERSION of a stored day, 1 for files saved without it
+        """
+        with np.load(self.file_name(day)) as arrays:
+            return int(arrays['version']) if 'version' in arrays.files else 1
+
+    def update(self, db: TransportDB) -> list:
+        """
+        Build features of days from the database which aren't in the store
+        yet or were built by an older version of build_features
+        Returns:
+            List of added days
+        """
+        stored = {day for day in self.days() if self.version(day) == FEATURES_VERSION}
+        new_days = [day for day in db.query('SELECT DISTINCT day FROM delays ORDER BY day')['day']
+                    if day not in stored]
+        for day in new_days:
+            self.put(day, build_features(db.query('SELECT * FROM delays WHERE day = ?', (day,))))
+        return new_days
+
+
+class DelayModel:
+    """
+    Linear model of delay with intercepts per hour of the day and shrunk
+    mean residuals per line and per stop
+
+    It trains in seconds on a CPU and predicts a whole batch with a matrix
+    product and two array lookups.
+    """
+
+    def __init__(self):
+        self.weights = None
+        self.lines = pd.Index([])
+        self.line_effects = np.zeros(0)
+        self.stops = pd.Index([])
+        self.stop_effects = np.zeros(0)
+
+    @staticmethod
+    def design_matrix(df: pd.DataFrame) -> np.ndarray:
+        hours = np.zeros((len(df), HOURS), dtype=np.float32)
+        hours[np.arange(len(df)), df['hour'].to_numpy(dtype=int)] = 1
+        return np.hstack([df[NUMERIC_FEATURES].to_numpy(dtype=np.float32), hours])
+
+    @staticmethod
+    def category_effects(categories: pd.Series, residuals: np.ndarray) -> tuple:
+        codes, index = pd.factorize(categories)
+        sums = np.bincount(codes, weights=residuals, minlength=len(index))
+        counts = np.bincount(codes, minlength=len(index))
+        return pd.Index(index), sums / (counts + SHRINKAGE)
+
+    def fit(self, df: pd.DataFrame) -> 'DelayModel':
+        """
+        Train the model on features from FeatureStore.load
+        """
+        X = self.design_matrix(df).astype(float)
+        y = df['delay'].to_numpy(dtype=float)
+
+        penalty = RIDGE * np.eye(X.shape[1])
+        self.weights = np.linalg.solve(X.T @ X + penalty, X.T @ y)
+
+        residuals = y - X @ self.weights
+        self.lines, self.line_effects = self.category_effects(df['line'], residuals)
+        residuals = residuals - self.lookup(self.lines, self.line_effects, df['line'])
+        self.stops, self.stop_effects = self.category_effects(df['stop'], residuals)
+        return self
+
+    @staticmethod
+    def lookup(index: pd.Index, effects: np.ndarray, categories: pd.Series) -> np.ndarray:
+        positions = index.get_indexer(categories)
+        return np.where(positions >= 0, effects[positions], 0.0)
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Predict delays (in seconds) of departures
+        """
+        return (self.design_matrix(df) @ self.weights + self.lookup(self.lines, self.line_effects, df['line'])
+                + self.lookup(self.stops, self.stop_effects, df['stop']))
+
+    def save(self, file_name: str = MODEL_FILE):
+        np.savez(file_name, weights=self.weights, lines=self.lines.to_numpy(dtype=str), line_effects=self.line_effects,
+                 stops=self.stops.to_numpy(dtype=str), stop_effects=self.stop_effects,
+                 features=np.array(NUMERIC_FEATURES))
+
+    @classmethod
+    def load(cls, file_name: str = MODEL_FILE) -> 'DelayModel':
+        model = cls()
+        with np.load(file_name) as arrays:
+            if arrays['features'].tolist() != NUMERIC_FEATURES:
+                raise ValueError(f'{file_name} was trained on different features')
+            model.weights = arrays['weights']
+            model.lines, model.line_effects = pd.Index(arrays['lines']), arrays['line_effects']
+            model.stops, model.stop_effects = pd.Index(arrays['stops']), arrays['stop_effects']
+        return model
+
+
+def evaluate(model: DelayModel, df: pd.DataFrame) -> dict:
+    """
+    Compare predictions with real delays and with the upstream delay as a baseline
+    Returns:
+        Dictionary with mean absolute errors and root mean squared errors in seconds
+    """
+    y = df['delay'].to_numpy(dtype=float)
+    error = model.predict(df) - y
+    baseline_error = df['upstream_delay'].to_numpy(dtype=float) - y
+    return {'departures': len(df),
+            'mae': float(np.abs(error).mean()), 'rmse': float(np.sqrt((error ** 2).mean())),
+            'baseline_mae': float(np.abs(baseline_error).mean()),
+            'baseline_rmse': float(np.sqrt((baseline_error ** 2).mean()))}
+
+
+def prediction_latency(model: DelayModel, df: pd.DataFrame, batch_size: int = BATCH_SIZE) -> float:
+    """
+    Measure time of batched inference
+    Returns:
+        Milliseconds per 1000 stop arrivals
+    """
+    start = time.perf_counter()
+    for first in range(0, len(df), batch_size):
+        model.predict(df.iloc[first:first + batch_size])
+    return (time.perf_counter() - start) * 1000 / len(df) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train and evaluate the delay prediction model')
+    parser.add_argument('--db', default='transport.sqlite', help='database made by the collectors')
+    parser.add_argument('--store', default=FEATURE_STORE_FOLDER, help='feature store folder')
+    parser.add_argument('--model', default=MODEL_FILE, help='file to save the trained model to')
+    parser.add_argument('--test-days', type=int, default=7, help='number of last days used for evaluation')
+    args = parser.parse_args()
+
+    store = FeatureStore(args.store)
+    db = TransportDB(args.db)
+    added = store.update(db)
+    db.close()
+    print(f'Feature store: {len(added)} new days, {len(store.days())} in total')
+
+    days = store.days()
+    train_days, test_days = days[:-args.test_days], days[-args.test_days:]
+    if not train_days:
+        raise SystemExit('Not enough days to train and evaluate the model')
+
+    model = DelayModel().fit(store.load(train_days))
+    model.save(args.model)
+
+    test = store.load(test_days)
+    print(json.dumps(evaluate(model, test), indent=4))
+    print(f'Prediction latency: {prediction_latency(model, test):.3f} ms per 1000 stop arrivals')
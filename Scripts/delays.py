@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from line_registry import LineRegistry
+from timetables import stop_sequences
+from trajectories import MAX_BACKWARD, MAX_ROUTE_OFFSET, TO_ROUTES_CRS, route_candidates
+from travel_times import boundary_passings
+
+# a departure is matched with a passing of its brigade at most this far (in seconds) from the schedule
+MAX_DELAY = 30 * 60
+
+# columns of the delays table of TransportDB
+DELAY_COLUMNS = ['day', 'line', 'brigade', 'vehicle', 'zespol', 'slupek', 'scheduled', 'delay']
+
+# projecting stops of a route code, leaving a stop out costs as much as this many meters along
+# the route, at most MAX_SKIPPED stops in a row are left out
+MAX_STOP_SPACING = 3000.0
+MAX_SKIPPED = 3
+
+# columns of the table of stops along routes made with route_stop_chainages
+CHAINAGE_COLUMNS = ['linia', 'trasa', 'zespol', 'slupek', 'Order', 'Chainage']
+
+
+def follow_route(candidates: pd.DataFrame, n_stops: int, route_length: float) -> np.ndarray:
+    """
+    Choose one candidate of every stop of a route code, so the stops follow
+    each other forward along the route with the shortest total distance
+    (Viterbi algorithm)
+    Arguments:
+        candidates: dataframe made with trajectories.route_candidates for
+                    stops in their timetable sequence
+        n_stops: number of stops
+        route_length: length of the route in meters
+    Returns:
+        Chainages of stops, NaN for stops without a candidate or left out.
+        A stop the route passes only behind its neighbours (e.g. at a
+        terminus, or where the geometry takes another track) would send a
+        vehicle around the whole loop, so up to MAX_SKIPPED stops in a row
+        can be left out for MAX_STOP_SPACING each
+    """
+    chainages = np.full(n_stops, np.nan)
+    points = candidates['Point'].to_numpy()
+    if not len(points):
+        return chainages
+    stops, first = np.unique(points, return_index=True)
+    bounds = np.r_[first, len(points)]
+    chainage = candidates['Chainage'].to_numpy()
+    offset = candidates['Offset'].to_numpy()
+
+    # cost of the best path ending at every candidate: distances along the route between stops
+    # (back by up to MAX_BACKWARD counts too), offsets and stops left out
+    costs = np.zeros(len(points))
+    previous = np.full(len(points), -1)
+    for k in range(len(stops)):
+        current = slice(bounds[k], bounds[k + 1])
+        # a path may start at any stop, leaving out the stops before it
+        best = np.full(bounds[k + 1] - bounds[k], k * MAX_STOP_SPACING)
+        came_from = np.full(len(best), -1)
+        for j in range(max(k - MAX_SKIPPED - 1, 0), k):
+            before = slice(bounds[j], bounds[j + 1])
+            step = (chainage[current][None, :] - chainage[before][:, None] + MAX_BACKWARD) % route_length - MAX_BACKWARD
+            total = costs[before][:, None] + np.abs(step) + (k - j - 1) * MAX_STOP_SPACING
+            nearest = np.argmin(total, axis=0)
+            value = total[nearest, np.arange(len(best))]
+            came_from = np.where(value < best, bounds[j] + nearest, came_from)
+            best = np.minimum(value, best)
+        costs[current] = best + offset[current]
+        previous[current] = came_from
+
+    # ... and end at any stop
+    stop_number = np.repeat(np.arange(len(stops)), np.diff(bounds))
+    candidate = int(np.argmin(costs + (len(stops) - 1 - stop_number) * MAX_STOP_SPACING))
+    while candidate >= 0:
+        chainages[points[candidate]] = chainage[candidate]
+        candidate = previous[candidate]
+    return chainages
+
+
+def route_stop_chainages(departures: pd.DataFrame, stops: pd.DataFrame, routes: dict,
+                         max_offset: float = MAX_ROUTE_OFFSET, registry: LineRegistry = None) -> pd.DataFrame:
+    """
+    Project stops of every (line, route code) onto the route geometry of the line
+    Arguments:
+        departures: timetables made with timetables.explode_timetables
+        stops: dataframe with 'zespol', 'slupek', 'szer_geo' and 'dlug_geo' columns
+        routes: dictionary made with trajectories.load_routes
+        max_offset: stops further from the route (in meters) are skipped
+        registry: line metadata of the snapshot, lines which aren't trams in
+                  it are skipped. None keeps every line with a route geometry
+    Returns:
+        Dataframe with CHAINAGE_COLUMNS: stops of every route code ('trasa')
+        of lines with a route geometry, with their 'Chainage' in meters and
+        numbered by their 'Order' along the route from the first stop of the
+        route code. Routes are there-and-back loops, so stops are projected
+        in their timetable sequence (see timetables.stop_sequences), each one
+        forward from the previous one, instead of onto the nearest leg
+    """
+    route_ids = set(routes) if registry is None else set(routes) & set(registry.lines_of_type('T'))
+    sequences = stop_sequences(departures[departures['linia'].isin(route_ids)])
+    located = sequences.merge(stops[['zespol', 'slupek', 'szer_geo', 'dlug_geo']].drop_duplicates(['zespol', 'slupek']),
+                              on=['zespol', 'slupek'])
+    located = located.sort_values(['linia', 'trasa', 'Sequence'], kind='stable').reset_index(drop=True)
+    x, y = TO_ROUTES_CRS.transform(located['dlug_geo'].astype(float).to_numpy(),
+                                   located['szer_geo'].astype(float).to_numpy())
+
+    chainages = np.full(len(located), np.nan)
+    for line, line_stops in located.groupby('linia', sort=False):
+        # candidates of all stops of a line are found at once, then split by route code
+        rows = line_stops.index.to_numpy()
+        candidates = route_candidates(routes[line], x[rows], y[rows], max_offset)
+        codes = line_stops['trasa'].to_numpy()
+        code_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        for first, last in zip(code_starts, np.r_[code_starts[1:], len(rows)]):
+            code_candidates = candidates[(candidates['Point'] >= first) & (candidates['Point'] < last)]
+            chainages[rows[first:last]] = follow_route(code_candidates.assign(Point=code_candidates['Point'] - first),
+                                                       last - first, routes[line].length)
+
+    result = located[['linia', 'trasa', 'zespol', 'slupek']].assign(Chainage=chainages)
+    result = result[result['Chainage'].notna()].reset_index(drop=True)
+    lengths = result['linia'].map({line: routes[line].length for line in route_ids})
+    first_chainage = result.groupby(['linia', 'trasa'])['Chainage'].transform('first')
+    # stops just behind the first one (e.g. at a terminus) stay after it
+    result['Along'] = np.maximum((result['Chainage'] - first_chainage + MAX_BACKWARD) % lengths - MAX_BACKWARD, 0)
+    result = result.sort_values(['linia', 'trasa', 'Along'], kind='stable').reset_index(drop=True)
+    result['Order'] = result.groupby(['linia', 'trasa']).cumcount()
+    return result[CHAINAGE_COLUMNS]
+
+
+def misordered_stops(chainages: pd.DataFrame, departures: pd.DataFrame) -> pd.DataFrame:
+    """
+    Check stops along routes against the timetables
+    Arguments:
+        chainages: dataframe made with route_stop_chainages
+        departures: timetables it was made from
+    Returns:
+        Rows of chainages whose 'Order' along the route differs from their
+        place in the timetable sequence of their route code
+    """
+    sequences = stop_sequences(departures[departures['linia'].isin(chainages['linia'].unique())])
+    merged = chainages.merge(sequences, on=['linia', 'trasa', 'zespol', 'slupek'], how='left')
+    expected = merged.sort_values('Sequence', kind='stable').groupby(['linia', 'trasa']).cumcount()
+    return chainages[(merged['Order'] != expected.sort_index()).to_numpy()]
+
+
+def line_delays(df: pd.DataFrame, route: shapely.LineString, departures: pd.DataFrame,
+                stops: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compute delays of one line at its stops
+    Arguments:
+        df: snapped positions of the line (see trajectories.snap_to_routes)
+        route: route geometry of the line
+        departures: departures of the line (see timetables.explode_timetables)
+        stops: dataframe with 'zespol', 'slupek' and 'Chainage' of stops of
+               the line, sorted by chainage
+    Returns:
+        Dataframe with 'brigade', 'vehicle', 'zespol', 'slupek', 'scheduled'
+        (minutes since midnight) and 'delay' (seconds, negative when early).
+        Every departure is matched with the nearest passing of its stop by a
+        vehicle of its brigade
+    """
+    df = df.sort_values(['VehicleNumber', 'Time'], kind='stable')
+    time_zero = df['Time'].min().floor('D')
+    passings = boundary_passings(df, route.length, stops['Chainage'].to_numpy())
+    passings = passings[passings['Observed']]
+    if passings.empty:
+        return pd.DataFrame(columns=DELAY_COLUMNS[2:])
+
+    stop_ids = (stops['zespol'] + '_' + stops['slupek']).to_numpy()
+    passing_keys = passings['Brigade'].astype(str).to_numpy() + '|' + stop_ids[passings['Boundary'].to_numpy()]
+    departure_keys = (departures['brygada'].astype(str) + '|' + departures['zespol'] + '_'
+                      + departures['slupek']).to_numpy()
+    codes, _ = pd.factorize(np.r_[passing_keys, departure_keys])
+    passing_codes, departure_codes = codes[:len(passing_keys)], codes[len(passing_keys):]
+
+    # passings sorted by (brigade and stop, time) in one flat array
+    passed = (passings['Passed'] - time_zero).dt.total_seconds().to_numpy()
+    scheduled = departures['minuty'].to_numpy() * 60.0
+    offset = max(passed.max(initial=0), scheduled.max(initial=0)) + 2 * MAX_DELAY
+    order = np.lexsort((passed, passing_codes))
+    flat_passed = (passing_codes * offset + passed)[order]
+    query = departure_codes * offset + scheduled
+
+    # nearest passing on either side of the scheduled time
+    after = np.searchsorted(flat_passed, query)
+    before = np.clip(after - 1, 0, None)
+    after = np.clip(after, 0, len(flat_passed) - 1)
+    nearest = np.where(np.abs(flat_passed[after] - query) < np.abs(flat_passed[before] - query), after, before)
+    delay = flat_passed[nearest] - query
+    matched = np.abs(delay) <= MAX_DELAY
+
+    return pd.DataFrame({'brigade': departures['brygada'].to_numpy()[matched],
+                         'vehicle': passings['VehicleNumber'].to_numpy()[order][nearest][matched],
+                         'zespol': departures['zespol'].to_numpy()[matched],
+                         'slupek': departures['slupek'].to_numpy()[matched],
+                         'scheduled': departures['minuty'].to_numpy()[matched],
+                         'delay': delay[matched]})
+
+
+def compute_delays(df: pd.DataFrame, routes: dict, departures: pd.DataFrame, chainages: pd.DataFrame,
+                   day: str) -> pd.DataFrame:
+    """
+    Compute delays of every line on one day
+    Arguments:
+        df: snapped positions made with trajectories.snap_to_routes
+        routes: dictionary made with trajectories.load_routes
+        departures: timetables made with timetables.explode_timetables
+        chainages: stops along routes made with route_stop_chainages
+        day: day of positions ('YYYY-MM-DD')
+    Returns:
+        Dataframe with DELAY_COLUMNS, ready for TransportDB.insert_delays
+    """
+    # stops of all route codes of a line, the chainage of a stop is the same for every code
+    line_chainages = {line: group.drop_duplicates(['zespol', 'slupek']).sort_values('Chainage', kind='stable')
+                      for line, group in chainages.groupby('linia', sort=False)}
+
+    frames = []
+    for line, group in df.groupby('Lines', sort=True):
+        line_departures = departures[departures['linia'] == line]
+        if line not in routes or line not in line_chainages or line_departures.empty:
+            continue
+        line_stops = line_chainages[line][['zespol', 'slupek', 'Chainage']].reset_index(drop=True)
+        frames.append(line_delays(group, routes[line], line_departures, line_stops).assign(line=line))
+
+    if not frames:
+        return pd.DataFrame(columns=DELAY_COLUMNS)
+    return pd.concat(frames, ignore_index=True).assign(day=day)[DELAY_COLUMNS]
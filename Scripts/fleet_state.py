@@ -0,0 +1,177 @@
+import math
+import threading
+from datetime import datetime
+
+import numpy as np
+
+# speed isn't derived from two fixes further apart (in seconds) than that
+MAX_SPEED_GAP = 300
+
+# initial number of vehicle slots, doubled when they run out
+INITIAL_CAPACITY = 1024
+
+EARTH_RADIUS = 6371000.0
+
+
+class VehicleState:
+    """
+    Last known state of one vehicle, a record of a FleetSnapshot. Speed is
+    in m/s, NaN for a first fix or one after a gap longer than MAX_SPEED_GAP
+    """
+    __slots__ = ('vehicle', 'line', 'brigade', 'lon', 'lat', 'time', 'speed')
+
+    def __init__(self, vehicle: str, line: str, brigade: str, lon: float, lat: float, time: datetime, speed: float):
+        self.vehicle = vehicle
+        self.line = line
+        self.brigade = brigade
+        self.lon = lon
+        self.lat = lat
+        self.time = time
+        self.speed = speed
+
+    def __repr__(self):
+        return (f'VehicleState(vehicle={self.vehicle!r}, line={self.line!r}, brigade={self.brigade!r}, '
+                f'lon={self.lon}, lat={self.lat}, time={self.time}, speed={self.speed:.1f})')
+
+
+class FleetSnapshot:
+    """
+    Read-only copy of the fleet state after one poll, safe to use from any
+    thread while the collector keeps updating the FleetState
+    """
+
+    def __init__(self, version: int, vehicles: np.ndarray, lines: np.ndarray, brigades: np.ndarray,
+                 lon: np.ndarray, lat: np.ndarray, time: np.ndarray, speed: np.ndarray):
+        self.version = version
+        self.vehicles = vehicles
+        self.lines = lines
+        self.brigades = brigades
+        self.lon = lon
+        self.lat = lat
+        self.time = time
+        self.speed = speed
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def records(self, mask: np.ndarray = None) -> list:
+        """
+        Get states of vehicles selected by a boolean mask, None gives all vehicles
+        """
+        indices = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        return [VehicleState(self.vehicles[i], self.lines[i], self.brigades[i], float(self.lon[i]),
+                             float(self.lat[i]), datetime.fromtimestamp(self.time[i]), float(self.speed[i]))
+                for i in indices]
+
+    def fresh(self, max_age: float = None, now: datetime = None) -> np.ndarray:
+        """
+        Get a mask of vehicles with a fix at most 'max_age' seconds old, None selects all vehicles
+        """
+        if max_age is None:
+            return np.ones(len(self), dtype=bool)
+        return self.time >= (now or datetime.now()).timestamp() - max_age
+
+    def line(self, line: str, max_age: float = None) -> list:
+        """
+        Get states of vehicles last seen on a line, e.g. where all line-33 trams are now
+        """
+        return self.records((self.lines == str(line)) & self.fresh(max_age))
+
+    def vehicle(self, vehicle: str) -> VehicleState:
+        records = self.records(self.vehicles == str(vehicle))
+        return records[0] if records else None
+
+
+class FleetState:
+    """
+    Live state of every vehicle (last position, time of the fix, line,
+    brigade and speed derived from the last two fixes), updated in place from
+    every poll of API_get_positions.py
+
+    Vehicles have fixed slots in preallocated arrays, found by VehicleNumber
+    in a dictionary, so a position is applied in O(1) without building a
+    dataframe. A whole poll is applied under a lock and readers get
+    FleetSnapshot copies, so they never see a half-applied poll.
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self.slots = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.vehicles = np.empty(capacity, dtype=object)
+        self.lines = np.empty(capacity, dtype=object)
+        self.brigades = np.empty(capacity, dtype=object)
+        self.lon = np.full(capacity, np.nan)
+        self.lat = np.full(capacity, np.nan)
+        self.time = np.full(capacity, -np.inf)
+        self.speed = np.full(capacity, np.nan)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def grow(self):
+        for name in ['vehicles', 'lines', 'brigades', 'lon', 'lat', 'time', 'speed']:
+            old = getattr(self, name)
+            new = np.empty(2 * len(old), dtype=old.dtype)
+            new[len(old):] = None if old.dtype == object else (-np.inf if name == 'time' else np.nan)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def update(self, positions: list) -> int:
+        """
+        Apply one poll
+        Arguments:
+            positions: 'result' of a busestrams_get answer, dictionaries with
+                       'VehicleNumber', 'Lines', 'Brigade', 'Lon', 'Lat' and 'Time'
+        Returns:
+            Number of vehicles with a new fix, repeated or older fixes are skipped
+        """
+        updated = 0
+        with self.lock:
+            for position in positions:
+                try:
+                    vehicle = str(position['VehicleNumber'])
+                    fix_time = datetime.fromisoformat(position['Time']).timestamp()
+                    lon, lat = float(position['Lon']), float(position['Lat'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+                slot = self.slots.get(vehicle)
+                if slot is None:
+                    slot = len(self.slots)
+                    if slot == len(self.vehicles):
+                        self.grow()
+                    self.slots[vehicle] = slot
+                    self.vehicles[slot] = vehicle
+                elif fix_time <= self.time[slot]:
+                    continue
+                else:
+                    seconds = fix_time - self.time[slot]
+                    self.speed[slot] = (distance(self.lon[slot], self.lat[slot], lon, lat) / seconds
+                                        if seconds <= MAX_SPEED_GAP else np.nan)
+
+                self.lines[slot] = str(position.get('Lines'))
+                self.brigades[slot] = str(position.get('Brigade'))
+                self.lon[slot], self.lat[slot], self.time[slot] = lon, lat, fix_time
+                updated += 1
+            self.version += 1
+        return updated
+
+    def snapshot(self) -> FleetSnapshot:
+        """
+        Get a consistent copy of the state of all vehicles
+        """
+        with self.lock:
+            n = len(self.slots)
+            return FleetSnapshot(self.version, self.vehicles[:n].copy(), self.lines[:n].copy(),
+                                 self.brigades[:n].copy(), self.lon[:n].copy(), self.lat[:n].copy(),
+                                 self.time[:n].copy(), self.speed[:n].copy())
+
+
+def distance(lon0: float, lat0: float, lon1: float, lat1: float) -> float:
+    """
+    Distance in meters between two close points (equirectangular approximation)
+    """
+    x = math.radians(lon1 - lon0) * math.cos(math.radians((lat0 + lat1) / 2))
+    y = math.radians(lat1 - lat0)
+    return EARTH_RADIUS * math.hypot(x, y)
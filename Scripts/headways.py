@@ -0,0 +1,255 @@
+import numpy as np
+import pandas as pd
+
+from line_registry import LineRegistry
+from trajectories import MAX_BACKWARD, MAX_SPEED
+
+# length of a step between two snapshots of a line
+SNAPSHOT_PERIOD = '30s'
+
+# a vehicle missing for longer than this (in seconds) is treated as out of service
+MAX_GAP = 300
+
+# passes of dropping implausible fixes, backward jumps left after them are clamped
+MAX_PASSES = 10
+
+# headways shorter (longer) than this part of the scheduled headway are bunching (long headways)
+BUNCHING_RATIO = 0.25
+GAP_RATIO = 2.0
+
+# offsets separating vehicles in the flattened arrays, greater than any time or progress
+TIME_OFFSET = 1e7  # seconds
+PROGRESS_OFFSET = 1e8  # meters
+
+
+def add_progress(df: pd.DataFrame, route_length: float) -> pd.DataFrame:
+    """
+    Unwrap chainage into distance covered along a route
+    Arguments:
+        df: snapped positions of one line (see trajectories.snap_to_routes)
+        sorted by 'VehicleNumber' and 'Time'
+        route_length: length of the route in meters
+    Returns:
+        Dataframe with an extra 'Progress' column: never decreasing distance
+        covered by every vehicle, 'Progress' modulo route length is the chainage.
+        Routes are loops (there and back), so passing the end of the route
+        continues from its start. Fixes making a step back by more than
+        MAX_BACKWARD or faster than MAX_SPEED are dropped, backward jumps
+        which can't be explained by one wrong fix are clamped, so progress
+        follows the chainage again right after them
+    """
+    def steps(df):
+        s = df['Chainage'].to_numpy(dtype=float)
+        t = df['Time'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+        vehicles = df['VehicleNumber'].to_numpy()
+        first = np.r_[True, vehicles[1:] != vehicles[:-1]]
+        # steps over a gap aren't checked, the vehicle could have gone anywhere
+        run_start = first | (np.diff(t, prepend=t[:1]) > MAX_GAP)
+        return s, t, first, run_start
+
+    def plausible(s, t, i, j):
+        ds = (s[j] - s[i] + route_length / 2) % route_length - route_length / 2
+        return (ds >= -MAX_BACKWARD) & (ds <= MAX_SPEED * np.maximum(t[j] - t[i], 1) + MAX_BACKWARD)
+
+    # drop the fix at either end of an implausible step, the one without which the track is plausible
+    for _ in range(MAX_PASSES):
+        s, t, first, run_start = steps(df)
+        k = np.flatnonzero(~run_start)
+        k = k[~plausible(s, t, k - 1, k)]
+        if not len(k):
+            break
+        n = len(s)
+        before_ok = run_start[k - 1] | plausible(s, t, np.maximum(k - 2, 0), k)
+        following = np.minimum(k + 1, n - 1)
+        after_ok = (k + 1 >= n) | run_start[following] | plausible(s, t, k - 1, following)
+        previous_wrong = before_ok & ~after_ok
+        drop = np.zeros(n, dtype=bool)
+        drop[k[previous_wrong] - 1] = True
+        drop[k[~previous_wrong]] = True
+        df = df[~drop]
+
+    s, t, first, run_start = steps(df)
+    ds = np.diff(s, prepend=s[:1])
+    ds = (ds + route_length / 2) % route_length - route_length / 2
+    # over a gap the vehicle moved forward, within a run what's left of backward jumps is clamped
+    ds = np.where(run_start, ds % route_length, np.where(ds < -MAX_BACKWARD, 0, ds))
+    ds[first] = s[first]
+
+    vehicles = df['VehicleNumber'].to_numpy()
+    progress = pd.Series(ds).groupby(vehicles).cumsum().groupby(vehicles).cummax()
+    return df.assign(Progress=progress.to_numpy())
+
+
+def line_snapshots(df: pd.DataFrame, route_length: float, period: str = SNAPSHOT_PERIOD) -> pd.DataFrame:
+    """
+    Interpolate positions of every vehicle of a line at common snapshot times
+    and find the vehicle ahead of each of them
+    Arguments:
+        df: dataframe made with add_progress
+        route_length: length of the route in meters
+        period: step between snapshots
+    Returns:
+        Dataframe with one row per vehicle and snapshot: 'Time', 'VehicleNumber',
+        'Brigade', 'Chainage', 'Leader' (vehicle ahead), 'Gap' (distance to the
+        leader in meters) and 'Headway' (seconds since the leader was where
+        the vehicle is now)
+    """
+    step = int(pd.Timedelta(period).total_seconds())
+    time_zero = df['Time'].min().floor('D')
+
+    codes, vehicle_names = pd.factorize(df['VehicleNumber'], sort=True)
+    brigades = df.groupby(codes)['Brigade'].first().to_numpy()
+    t = (df['Time'] - time_zero).dt.total_seconds().to_numpy()
+    progress = df['Progress'].to_numpy(dtype=float)
+
+    # vehicles are concatenated in flat arrays, each one shifted by a big offset
+    flat_t = codes * TIME_OFFSET + t
+    flat_progress = codes * PROGRESS_OFFSET + progress
+    n_vehicles = len(vehicle_names)
+    t_first = np.full(n_vehicles, np.inf)
+    t_last = np.full(n_vehicles, -np.inf)
+    np.minimum.at(t_first, codes, t)
+    np.maximum.at(t_last, codes, t)
+    progress_first = np.full(n_vehicles, np.inf)
+    np.minimum.at(progress_first, codes, progress)
+
+    # snapshot times of every vehicle between its first and last fix
+    grid_first = np.ceil(t_first / step) * step
+    counts = np.maximum(np.floor((t_last - grid_first) / step) + 1, 0).astype(np.int64)
+    q_vehicle = np.repeat(np.arange(n_vehicles), counts)
+    q_t = np.repeat(grid_first, counts) + step * (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+    # positions at snapshot times, skipping periods when a vehicle is missing
+    query = q_vehicle * TIME_OFFSET + q_t
+    after = np.clip(np.searchsorted(flat_t, query, side='left'), 0, len(flat_t) - 1)
+    before = np.clip(after - 1, 0, None)
+    present = (flat_t[after] == query) | (flat_t[after] - flat_t[before] <= MAX_GAP)
+    q_vehicle, q_t, query = q_vehicle[present], q_t[present], query[present]
+    q_progress = np.interp(query, flat_t, progress)
+    q_chainage = q_progress % route_length
+
+    # time when every vehicle got to its current progress, of vehicles at the same chainage
+    # (e.g. waiting at a terminus) the one which got there first is ahead
+    arrived = flat_t[np.searchsorted(flat_progress, q_vehicle * PROGRESS_OFFSET + q_progress, side='left')]
+
+    # order vehicles by chainage in every snapshot, the next one is the leader
+    order = np.lexsort((-arrived, q_chainage, q_t))
+    q_vehicle, q_t, q_progress, q_chainage = q_vehicle[order], q_t[order], q_progress[order], q_chainage[order]
+    group_start = np.r_[True, q_t[1:] != q_t[:-1]]
+    starts = np.flatnonzero(group_start)
+    sizes = np.diff(np.r_[starts, len(q_t)])
+    position = np.arange(len(q_t)) - np.repeat(starts, sizes)
+    leader = np.repeat(starts, sizes) + (position + 1) % np.repeat(sizes, sizes)
+    alone = np.repeat(sizes, sizes) == 1
+
+    gap = (q_chainage[leader] - q_chainage) % route_length
+    # the leader of the last one of vehicles at the same chainage is a whole loop ahead
+    gap[(gap == 0) & (position + 1 == np.repeat(sizes, sizes))] = route_length
+    leader_vehicle = q_vehicle[leader]
+    target = q_progress[leader] - gap
+
+    # time when the leader was at the current position of the vehicle
+    flat_target = leader_vehicle * PROGRESS_OFFSET + target
+    after = np.clip(np.searchsorted(flat_progress, flat_target, side='left'), 1, len(flat_progress) - 1)
+    p0, p1 = flat_progress[after - 1], flat_progress[after]
+    t0, t1 = flat_t[after - 1], flat_t[after]
+    fraction = np.where(p1 > p0, (flat_target - p0) / np.where(p1 > p0, p1 - p0, 1), 1)
+    passed = t0 + np.clip(fraction, 0, 1) * (t1 - t0) - leader_vehicle * TIME_OFFSET
+    headway = q_t - passed
+    headway[alone | (target < progress_first[leader_vehicle])] = np.nan
+
+    return pd.DataFrame({
+        'Time': time_zero + pd.to_timedelta(q_t, unit='s'),
+        'VehicleNumber': vehicle_names[q_vehicle],
+        'Brigade': brigades[q_vehicle],
+        'Chainage': q_chainage,
+        'Leader': np.where(alone, None, vehicle_names[leader_vehicle].to_numpy(dtype=object)),
+        'Gap': np.where(alone, np.nan, gap),
+        'Headway': headway,
+    })
+
+
+def scheduled_headways(departures: pd.DataFrame, bin_minutes: int = 15) -> pd.DataFrame:
+    """
+    Get scheduled headways of lines in time of day bins
+    Arguments:
+        departures: dataframe made with timetables.explode_timetables
+        bin_minutes: length of a time of day bin
+    Returns:
+        Dataframe with 'Lines', 'Bin' (number of a bin since midnight) and
+        'Scheduled' (median time in seconds between two departures of a line
+        from the same stop)
+    """
+    departures = departures.sort_values(['linia', 'zespol', 'slupek', 'minuty'], kind='stable')
+    interval = departures.groupby(['linia', 'zespol', 'slupek'])['minuty'].diff()
+
+    result = pd.DataFrame({'Lines': departures['linia'], 'Bin': departures['minuty'] // bin_minutes,
+                           'Scheduled': interval * 60})
+    result = result[result['Scheduled'] > 0]
+    return result.groupby(['Lines', 'Bin'], as_index=False)['Scheduled'].median()
+
+
+def network_headways(df: pd.DataFrame, routes: dict, departures: pd.DataFrame = None,
+                     period: str = SNAPSHOT_PERIOD, bin_minutes: int = 15,
+                     registry: LineRegistry = None) -> pd.DataFrame:
+    """
+    Compute headways of every line and flag bunching and gaps
+    Arguments:
+        df: snapped positions made with trajectories.snap_to_routes
+        routes: dictionary made with trajectories.load_routes
+        departures: timetables made with timetables.explode_timetables, None
+        skips the comparison with the schedule
+        period: step between snapshots
+        bin_minutes: length of time of day bins of scheduled headways
+        registry: line metadata of the timetables snapshot, lines which aren't
+                  trams in it are skipped. None keeps every line with a route geometry
+    Returns:
+        Dataframe made with line_snapshots for every line with an extra
+        'Lines' column and, if departures are given, 'Scheduled' headway and
+        'Bunching' and 'LongHeadway' flags
+    """
+    lines = set(routes) if registry is None else set(routes) & set(registry.lines_of_type('T'))
+    frames = []
+    for line, group in df.groupby('Lines', sort=True):
+        if line not in lines:
+            continue
+        length = routes[line].length
+        group = group.sort_values(['VehicleNumber', 'Time'], kind='stable')
+        frames.append(line_snapshots(add_progress(group, length), length, period).assign(Lines=line))
+
+    if not frames:
+        return pd.DataFrame(columns=['Time', 'VehicleNumber', 'Brigade', 'Chainage', 'Leader', 'Gap', 'Headway',
+                                     'Lines'])
+    result = pd.concat(frames, ignore_index=True)
+
+    if departures is not None:
+        minutes = result['Time'].dt.hour * 60 + result['Time'].dt.minute
+        result['Bin'] = minutes // bin_minutes
+        result = result.merge(scheduled_headways(departures, bin_minutes), on=['Lines', 'Bin'], how='left')
+        result['Bunching'] = result['Headway'] < BUNCHING_RATIO * result['Scheduled']
+        result['LongHeadway'] = result['Headway'] > GAP_RATIO * result['Scheduled']
+        del result['Bin']
+
+    return result
+
+
+def bunching_events(df: pd.DataFrame, period: str = SNAPSHOT_PERIOD) -> pd.DataFrame:
+    """
+    Merge consecutive bunched snapshots of a vehicle into events
+    Arguments:
+        df: dataframe made with network_headways (with departures)
+        period: step between snapshots
+    Returns:
+        Dataframe with one row per event: 'Lines', 'VehicleNumber', 'Leader',
+        'Start', 'End' and 'MinHeadway' (in seconds)
+    """
+    df = df[df['Bunching']].sort_values(['Lines', 'VehicleNumber', 'Time'], kind='stable')
+
+    step = pd.Timedelta(period)
+    new_event = ((df['VehicleNumber'] != df['VehicleNumber'].shift()) | (df['Leader'] != df['Leader'].shift())
+                 | (df['Time'] - df['Time'].shift() > step))
+    event = new_event.cumsum()
+
+    return df.groupby(event).agg(Lines=('Lines', 'first'), VehicleNumber=('VehicleNumber', 'first'),
+                                 Leader=('Leader', 'first'), Start=('Time', 'first'), End=('Time', 'last'),
+                                 MinHeadway=('Headway', 'min')).reset_index(drop=True)
@@ -0,0 +1,102 @@
+import json
+import os
+import re
+
+import pandas as pd
+
+from timetables import explode_timetables
+
+# vehicle types, recognized by the first character of a line number
+VEHICLE_TYPES = {'W': 'WKD',  # WKD train
+                 'R': 'R',  # KM train
+                 'S': 'S',  # SKM train
+                 'M': 'M'}  # metro
+
+# saved next to the timetables snapshot of the same day (rozklady_{date})
+REGISTRY_FILE = 'linie_{date}.json'
+
+
+def classify_line(line: str) -> str:
+    """
+    Get the vehicle type of a line: T (tram), A (bus), M (metro), S (SKM
+    train), R (KM train) or WKD (WKD train)
+    """
+    line = str(line)
+    if line[:1] in VEHICLE_TYPES:
+        return VEHICLE_TYPES[line[:1]]
+    # tram lines have at most two characters
+    return 'T' if len(line) <= 2 else 'A'
+
+
+def registry_file_name(timetables_file: str) -> str:
+    """
+    Get the registry file of a timetables snapshot (rozklady_YYYY-MM-DD folder, .pkl or .csv)
+    """
+    day = re.search(r'rozklady_(\d{4}-\d{2}-\d{2})', timetables_file).group(1)
+    return os.path.join(os.path.dirname(timetables_file.rstrip('/')), REGISTRY_FILE.format(date=day))
+
+
+class LineRegistry:
+    """
+    Metadata of every line in one stops and timetables snapshot: vehicle
+    type, stops ('zespol_slupek') and route codes (e.g. 'TP-KIE')
+
+    It's built once per download and saved next to the snapshot, so other
+    scripts look lines up in dictionaries instead of deriving the metadata
+    from timetables row by row.
+    """
+
+    def __init__(self, lines: dict):
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, line: str) -> bool:
+        return line in self.lines
+
+    @classmethod
+    def from_timetables(cls, df: pd.DataFrame) -> 'LineRegistry':
+        """
+        Build the registry from a timetables dataframe (see timetables.explode_timetables),
+        lines without departures are skipped
+        """
+        return cls.from_departures(explode_timetables(df))
+
+    @classmethod
+    def from_departures(cls, departures: pd.DataFrame) -> 'LineRegistry':
+        """
+        Build the registry from departures made with timetables.explode_timetables
+        """
+        departures = departures.assign(przystanek=departures['zespol'] + '_' + departures['slupek'])
+        stops = departures.groupby('linia')['przystanek'].unique()
+        routes = departures.groupby('linia')['trasa'].unique()
+
+        return cls({line: {'typ': classify_line(line), 'przystanki': sorted(stops[line]),
+                           'trasy': sorted(routes[line])}
+                    for line in sorted(stops.index)})
+
+    def vehicle_type(self, line: str) -> str:
+        return self.lines[line]['typ']
+
+    def stops(self, line: str) -> list:
+        return self.lines[line]['przystanki']
+
+    def routes(self, line: str) -> list:
+        return self.lines[line]['trasy']
+
+    def lines_of_type(self, vehicle_type: str = None) -> list:
+        """
+        Get numbers of all lines of a type (T, A, M, S, R or WKD), None gives all lines
+        """
+        return [line for line, metadata in self.lines.items()
+                if vehicle_type is None or metadata['typ'] == vehicle_type]
+
+    def save(self, file_name: str):
+        with open(file_name, 'w') as f:
+            json.dump(self.lines, f)
+
+    @classmethod
+    def load(cls, file_name: str) -> 'LineRegistry':
+        with open(file_name) as f:
+            return cls(json.load(f))
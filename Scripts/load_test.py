@@ -0,0 +1,132 @@
+'''
+Load test of the collectors against mock_api_server.py
+
+Runs the stops/timetables crawl of API_get_stops.py and the polling of
+API_get_positions.py against a local mock API and reports throughput, tail
+latency and memory, e.g.:
+
+    python load_test.py --stops 200 --polls 50 --vehicles 1500 --latency 0.05
+'''
+
+import logging
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import requests
+
+import API_get_positions
+import API_get_stops
+from mock_api_server import MockData, make_server, parse_arguments
+
+
+class LatencyRecorder:
+    """
+    Record the duration of every requests.get call made by the collectors
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.original_get = requests.get
+
+    def __enter__(self):
+        def timed_get(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return self.original_get(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+        requests.get = timed_get
+        return self
+
+    def __exit__(self, *exc_info):
+        requests.get = self.original_get
+
+
+def report(name: str, seconds: float, latencies: list, peak_memory: int, rows: int):
+    """
+    Print results of a single test
+    """
+    latencies = np.array(latencies) * 1000
+    print(f'=== {name} ===')
+    print(f'requests:           {len(latencies)}')
+    print(f'wall time:          {seconds:.2f} s')
+    print(f'throughput:         {len(latencies) / seconds:.1f} requests/s, {rows / seconds:.1f} rows/s')
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f'latency p50/p95/p99/max: {p50:.1f} / {p95:.1f} / {p99:.1f} / {latencies.max():.1f} ms')
+    print(f'peak Python memory: {peak_memory / 1024 ** 2:.1f} MB')
+
+
+def test_stops_collector(stops_limit: int, only_trams: bool):
+    """
+    Crawl stops, lines and timetables like API_get_stops.run_script does
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    with LatencyRecorder() as recorder:
+        df = API_get_stops.make_stops_table('LOAD_TEST')
+        df = df.head(stops_limit)
+        df = API_get_stops.add_lines_to_stops_table(df, 'LOAD_TEST')
+        df = API_get_stops.make_timetables_for_lines(df, 'LOAD_TEST', only_trams=only_trams)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    rows = sum(len(times) for timetable in df['linie'] for times in timetable.values())
+    report('API_get_stops.py', seconds, recorder.latencies, peak_memory, rows)
+    print('collector stages:', API_get_stops.metrics.to_dict()['timers'])
+
+
+def test_positions_collector(link: str, polls: int):
+    """
+    Poll vehicle positions like API_get_positions.run_script does, without
+    waiting between polls
+    """
+    rows = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    with LatencyRecorder() as recorder, tempfile.TemporaryDirectory() as folder:
+        for _ in range(polls):
+            positions, _ = API_get_positions.poll_positions(link, folder)
+            rows += len(positions)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    report('API_get_positions.py', seconds, recorder.latencies, peak_memory, rows)
+    print('collector stages:', API_get_positions.metrics.to_dict()['timers'])
+
+
+if __name__ == '__main__':
+    parser = parse_arguments()
+    parser.description = 'Load test of the collectors against a mock UM Warszawa API'
+    parser.add_argument('--stops', type=int, default=100, help='number of stops to crawl, 0 skips the test')
+    parser.add_argument('--only-trams', action='store_true', help='crawl only tram stops')
+    parser.add_argument('--polls', type=int, default=20, help='number of position polls, 0 skips the test')
+    args = parser.parse_args()
+
+    print('Loading sample data...')
+    data = MockData(args.stops_file, args.timetables_file, args.positions_file, args.vehicles, args.scale)
+    server = make_server(data, port=0, latency=args.latency, error_rate=args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f'http://127.0.0.1:{server.server_address[1]}/api/action/'
+
+    # point the collectors at the mock API, without the cache and waiting between retries
+    API_get_stops.API_URL = api_url
+    API_get_stops.cache = None
+    API_get_stops.RETRY_WAIT = 0
+    API_get_stops.logs = logging.getLogger('load_test')
+
+    if args.stops > 0:
+        test_stops_collector(args.stops, args.only_trams)
+    if args.polls > 0:
+        test_positions_collector(api_url + 'busestrams_get/?resource_id=%20f2e5503e-927d-4ad3-9500-4ab9e55deb59'
+                                 '&apikey=LOAD_TEST&type=2', args.polls)
+
+    print(f'peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+    server.shutdown()
@@ -0,0 +1,159 @@
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds (in seconds) of request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Metrics:
+    """
+    Thread-safe counters, stage timers and histograms of a collector script
+
+    Stage timers and histograms are exported in the Prometheus text format
+    (as '<name>_seconds_sum', '<name>_seconds_count' and '<name>_bucket')
+    or as a JSON dictionary.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.counters = {}
+        self.timers = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        """
+        Increase counter 'name' by 'value'
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, stage: str, seconds: float):
+        """
+        Add 'seconds' to the timer of stage 'stage'
+        """
+        with self.lock:
+            total, count = self.timers.get(stage, (0.0, 0))
+            self.timers[stage] = (total + seconds, count + 1)
+
+    def observe(self, name: str, seconds: float):
+        """
+        Put a duration into histogram 'name' (and into timer 'name' as well)
+        """
+        with self.lock:
+            buckets = self.histograms.setdefault(name, [0] * len(LATENCY_BUCKETS))
+            for n, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[n] += 1
+                    break
+        self.add_time(name, seconds)
+
+    @contextmanager
+    def timer(self, stage: str, histogram: bool = False):
+        """
+        Measure time spent in a 'with' block
+        Arguments:
+            stage: name of the stage, e.g. 'request', 'parse' or 'write'
+            histogram: put the duration into a histogram as well
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if histogram:
+                self.observe(stage, seconds)
+            else:
+                self.add_time(stage, seconds)
+
+    def to_dict(self) -> dict:
+        """
+        Get all metrics as a JSON-serializable dictionary
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {stage: {'seconds': total, 'count': count} for stage, (total, count) in self.timers.items()},
+                'histograms': {name: dict(zip([str(bound) for bound in LATENCY_BUCKETS], buckets))
+                               for name, buckets in self.histograms.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Get all metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            lines = []
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+                lines.append(f'{self.prefix}_{name}_total {value}')
+            for stage, (total, count) in sorted(self.timers.items()):
+                if stage in self.histograms:
+                    continue
+                lines.append(f'# TYPE {self.prefix}_{stage}_seconds summary')
+                lines.append(f'{self.prefix}_{stage}_seconds_sum {total}')
+                lines.append(f'{self.prefix}_{stage}_seconds_count {count}')
+            for name, buckets in sorted(self.histograms.items()):
+                total, count = self.timers[name]
+                lines.append(f'# TYPE {self.prefix}_{name}_seconds histogram')
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f'{self.prefix}_{name}_seconds_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f'{self.prefix}_{name}_seconds_sum {total}')
+                lines.append(f'{self.prefix}_{name}_seconds_count {count}')
+            return '\n'.join(lines) + '\n'
+
+    def write_json(self, file_name: str):
+        """
+        Save all metrics to a JSON file
+        """
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def serve(self, port: int) -> HTTPServer:
+        """
+        Serve metrics at http://localhost:'port'/metrics from a background thread
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def run_profiled(f, profile_file_name: str = None):
+    """
+    Run function 'f', optionally under cProfile
+    Arguments:
+        f: a callable function without arguments
+        profile_file_name: where to dump cProfile stats (readable with pstats
+        or snakeviz), None runs 'f' without profiling
+    Returns:
+        Output of 'f'
+    """
+    if profile_file_name is None:
+        return f()
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(f)
+    finally:
+        profiler.dump_stats(profile_file_name)
@@ -0,0 +1,184 @@
+'''
+Local stand-in for UM Warszawa API serving busestrams_get, dbstore_get and
+dbtimetable_get answers synthesized from sample data in the repository.
+
+Run it and point the collectors at it with the UM_API_URL variable, e.g.:
+
+    python mock_api_server.py --port 8000 --latency 0.2 --error-rate 0.01
+    UM_API_URL=http://localhost:8000/api/action/ python API_get_stops.py
+'''
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from timetables import explode_timetables, load_timetables
+
+SAMPLES_FOLDER = '../00_Test_notebooks/'
+STOPS_FILE = SAMPLES_FOLDER + '05_Routes_visual_test/przystanki_2022-10-22.pkl'
+TIMETABLES_FILE = SAMPLES_FOLDER + '05_Routes_visual_test/rozklady_2022-10-22.pkl'
+POSITIONS_FILE = SAMPLES_FOLDER + '01_Animation_test/2022_04_15_sample.csv'
+
+# resource ids used by API_get_stops.py
+LINES_RESOURCE_ID = '88cd555f-6f31-43ca-9de4-66c479ad5942'
+TIMETABLE_RESOURCE_ID = 'e923fa0e-d96c-43f9-ae6e-60518c9f3238'
+
+STOP_KEYS = ['zespol', 'slupek', 'nazwa_zespolu', 'id_ulicy', 'szer_geo', 'dlug_geo', 'kierunek', 'obowiazuje_od']
+
+# the API answers with a string instead of a list when something goes wrong
+ERROR_ANSWER = {'result': 'Błędna metoda lub parametry wywołania'}
+
+
+def key_values(pairs: list) -> dict:
+    """
+    Make a dbstore/dbtimetable entry from (key, value) pairs
+    """
+    return {'values': [{'value': value, 'key': key} for key, value in pairs]}
+
+
+class MockData:
+    """
+    Sample stops, timetables and positions indexed for fast answers
+    Arguments:
+        stops_file: stops pickle (przystanki_YYYY-MM-DD.pkl)
+        timetables_file: timetables pickle or csv (rozklady_YYYY-MM-DD.*)
+        positions_file: csv with GPS positions of a vehicle (2022_04_15_sample.csv)
+        vehicles: number of vehicles in busestrams_get answers, every one
+        replays the sample trajectory with a different time shift
+        scale: every dbstore/dbtimetable answer repeats its entries 'scale'
+        times, to test bigger payloads
+    """
+
+    def __init__(self, stops_file: str, timetables_file: str, positions_file: str, vehicles: int = 300,
+                 scale: int = 1):
+        self.scale = scale
+
+        stops = pd.read_pickle(stops_file, compression='zip')
+        self.stops_answer = {'result': [key_values([(key, row[key]) for key in STOP_KEYS])
+                                        for row in stops[STOP_KEYS].to_dict('records')] * scale}
+
+        departures = explode_timetables(load_timetables(timetables_file))
+        self.departures = departures[['brygada', 'trasa', 'czas']].to_numpy()
+        self.lines_at_stop = departures.groupby(['zespol', 'slupek'])['linia'].unique().to_dict()
+        self.departures_at_stop = departures.groupby(['zespol', 'slupek', 'linia']).indices
+
+        positions = pd.read_csv(positions_file).dropna(subset=['lat', 'lon', 'ol', 'ob'])
+        times = pd.to_datetime(positions['lsh_time'].str[:19], format='%Y-%m-%d %H:%M:%S')
+        order = np.argsort(times.to_numpy(), kind='stable')
+        seconds = (times - times.min()).dt.total_seconds().to_numpy()[order]
+        self.position_seconds = seconds
+        self.position_lat = positions['lat'].to_numpy()[order]
+        self.position_lon = positions['lon'].to_numpy()[order]
+        self.position_line = positions['ol'].astype(int).astype(str).to_numpy()[order]
+        self.duration = seconds[-1] + 1
+        self.shifts = np.arange(vehicles) * self.duration / max(vehicles, 1)
+        self.started = time.time()
+
+    def stops(self) -> dict:
+        return self.stops_answer
+
+    def lines(self, zespol: str, slupek: str) -> dict:
+        lines = self.lines_at_stop.get((zespol, slupek), [])
+        return {'result': [key_values([('linia', line)]) for line in lines] * self.scale}
+
+    def timetable(self, zespol: str, slupek: str, line: str) -> dict:
+        rows = self.departures[self.departures_at_stop.get((zespol, slupek, line), np.empty(0, dtype=int))]
+        return {'result': [key_values([('symbol_2', 'null'), ('symbol_1', 'null'), ('brygada', brigade),
+                                       ('kierunek', ''), ('trasa', route), ('czas', f'{departure}:00')])
+                           for brigade, route, departure in rows] * self.scale}
+
+    def positions(self) -> dict:
+        now = datetime.now().replace(microsecond=0)
+        clock = (time.time() - self.started + self.shifts) % self.duration
+        index = np.maximum(np.searchsorted(self.position_seconds, clock, side='right') - 1, 0)
+        age = (clock - self.position_seconds[index]).astype(int)
+
+        return {'result': [{'Lines': line, 'Lon': lon, 'VehicleNumber': str(1000 + n),
+                            'Time': (now - timedelta(seconds=int(fix_age))).strftime('%Y-%m-%d %H:%M:%S'),
+                            'Lat': lat, 'Brigade': str(n + 1)}
+                           for n, (line, lon, lat, fix_age) in enumerate(zip(self.position_line[index].tolist(),
+                                                                            self.position_lon[index].tolist(),
+                                                                            self.position_lat[index].tolist(),
+                                                                            age.tolist()))]}
+
+
+def make_server(data: MockData, host: str = '127.0.0.1', port: int = 8000, latency: float = 0.0,
+                error_rate: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Make a mock API server, call serve_forever() on it to start serving
+    Arguments:
+        data: sample data made with MockData
+        host, port: address to listen on, port 0 picks a free port
+        latency: mean answer delay in seconds (exponentially distributed)
+        error_rate: fraction of requests answered with an API error message
+    Returns:
+        Server object, its address is in server.server_address
+    """
+
+    class MockHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            params = {name: values[0] for name, values in parse_qs(parts.query).items()}
+            endpoint = parts.path.rstrip('/').split('/')[-1]
+
+            if latency > 0:
+                time.sleep(random.expovariate(1 / latency))
+
+            if random.random() < error_rate:
+                answer = ERROR_ANSWER
+            elif endpoint == 'busestrams_get':
+                answer = data.positions()
+            elif endpoint == 'dbstore_get':
+                answer = data.stops()
+            elif endpoint == 'dbtimetable_get' and params.get('id') == LINES_RESOURCE_ID:
+                answer = data.lines(params.get('busstopId'), params.get('busstopNr'))
+            elif endpoint == 'dbtimetable_get' and params.get('id') == TIMETABLE_RESOURCE_ID:
+                answer = data.timetable(params.get('busstopId'), params.get('busstopNr'), params.get('line'))
+            else:
+                answer = ERROR_ANSWER
+
+            body = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), MockHandler)
+
+
+def parse_arguments(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """
+    Add mock server options to an argument parser
+    """
+    parser = parser or argparse.ArgumentParser(description='Mock UM Warszawa API server')
+    parser.add_argument('--stops-file', default=STOPS_FILE)
+    parser.add_argument('--timetables-file', default=TIMETABLES_FILE)
+    parser.add_argument('--positions-file', default=POSITIONS_FILE)
+    parser.add_argument('--vehicles', type=int, default=300, help='number of vehicles in busestrams_get answers')
+    parser.add_argument('--scale', type=int, default=1, help='repeat entries of dbstore/dbtimetable answers')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean answer delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of answers with an API error')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = parse_arguments()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    data = MockData(args.stops_file, args.timetables_file, args.positions_file, args.vehicles, args.scale)
+    server = make_server(data, args.host, args.port, args.latency, args.error_rate)
+    print(f'Serving mock API at http://{args.host}:{args.port}/api/action/ ...')
+    server.serve_forever()
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import json
+
+# orjson is optional, it decodes API answers a few times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(content: bytes):
+    """
+    Decode a JSON answer of the API, with orjson if it's installed
+    Arguments:
+        content: raw body of the answer
+    Returns:
+        Decoded JSON object
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def decode_columns(result: list, keys: list = None) -> dict:
+    """
+    Turn a dbstore_get/dbtimetable_get result into columns
+    Arguments:
+        result: list of entries in a format:
+            {'values': [{'value': '01', 'key': 'slupek'},
+                        {'value': 'Kijowska', 'key': 'nazwa_zespolu'},
+                        ...]}
+        keys: keys to extract, None extracts keys of the first entry
+    Returns:
+        Dictionary {key: list of values}, every entry is walked only once and
+        missing keys are filled with None
+    """
+    if keys is None:
+        keys = [pair['key'] for pair in result[0]['values']] if result else []
+
+    columns = {key: [] for key in keys}
+    appends = [(key, columns[key].append) for key in keys]
+    for entry in result:
+        row = {pair['key']: pair['value'] for pair in entry['values']}
+        for key, append in appends:
+            append(row.get(key))
+
+    return columns
+
+
+def decode_table(result: list, keys: list = None, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Turn a dbstore_get/dbtimetable_get result into a dataframe
+    Arguments:
+        result: list of entries with key/value pairs (see decode_columns)
+        keys: keys to extract, None extracts keys of the first entry
+        dtypes: optional types of columns, e.g. {'szer_geo': float}, other
+        columns are kept as strings
+    Returns:
+        Dataframe with one column per key
+    """
+    # pandas is imported here, so the collectors start without it
+    import pandas as pd
+
+    df = pd.DataFrame(decode_columns(result, keys))
+    if dtypes:
+        df = df.astype(dtypes)
+    return df
@@ -0,0 +1,233 @@
+'''
+Compressed archive of past days of GPS positions
+
+Hourly txt files written by API_get_positions.py are compacted into one file
+per day made of independently compressed chunks of CHUNK_MINUTES of polls,
+with a json index of the time range and lines of every chunk. Readers
+decompress only the chunks a query needs, e.g.:
+
+    python positions_archive.py --folder data/Positions/ --remove
+'''
+
+import argparse
+import glob
+import json
+import os
+import re
+import zlib
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from constants import GPS_POSITIONS_FOLDER
+from payloads import loads
+from trajectories import (POSITION_COLUMNS, parse_positions_text, position_files_for_day, positions_entries,
+                          read_positions_file)
+
+# zstd is optional, it compresses positions better and faster than zlib (ZIP/GZIP)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# polls in one compressed chunk
+CHUNK_MINUTES = 15
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read this archive')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def archive_file_names(day: date, folder: str, prefix: str = 'trams_') -> tuple:
+    """
+    Get names of the data and index files of an archived day, stored in the
+    same MONTH_YEAR folders as the hourly files
+    Returns:
+        Tuple (data file name, index file name)
+    """
+    base = os.path.join(folder, f'{day.month}_{day.year}', f'{prefix}{day.year}_{day.month}_{day.day}')
+    return base + '.chunks', base + '.index.json'
+
+
+def split_into_chunks(entries: list) -> list:
+    """
+    Split entries of hourly txt files (see trajectories.positions_entries)
+    into chunks of CHUNK_MINUTES of polls
+    Returns:
+        List of tuples (first poll time, last poll time, lines, text of the chunk)
+    """
+    chunks = {}
+    for poll_time, payload in entries:
+        try:
+            polled = datetime.strptime(poll_time, '%Y-%m-%d %H:%M:%S')
+            result = loads(payload)['result']
+        except (ValueError, KeyError):
+            continue
+        key = polled.replace(minute=polled.minute - polled.minute % CHUNK_MINUTES, second=0)
+        chunk = chunks.setdefault(key, [polled, polled, set(), []])
+        chunk[0], chunk[1] = min(chunk[0], polled), max(chunk[1], polled)
+        if isinstance(result, list):
+            chunk[2].update(str(entry.get('Lines')) for entry in result)
+        chunk[3].append(f'{poll_time}\n{payload}\n\n')
+
+    return [(first, last, sorted(lines_in_chunk), ''.join(entries))
+            for _, (first, last, lines_in_chunk, entries) in sorted(chunks.items())]
+
+
+def compact_day(day: date, folder: str = GPS_POSITIONS_FOLDER, prefix: str = 'trams_', remove: bool = False) -> dict:
+    """
+    Compact hourly txt files of one day into a chunked, compressed archive
+    Arguments:
+        day: day of collection
+        folder: root folder of the positions archive
+        prefix: 'trams_' or 'buses_', as set by API_get_positions.py
+        remove: delete the hourly files once the archive is written and
+                holds every position of them
+    Returns:
+        Index of the archive, None if there are no hourly files. 'removed'
+        tells if the hourly files were deleted
+    """
+    file_names = position_files_for_day(day, folder, prefix)
+    if not file_names:
+        return None
+
+    # every file is split on its own, so a file cut off mid-write doesn't affect the next ones
+    entries = []
+    raw_bytes = 0
+    for file_name in file_names:
+        with open(file_name, 'r') as f:
+            text = f.read()
+        entries.extend(positions_entries(text))
+        raw_bytes += len(text.encode())
+
+    codec = 'zstd' if zstandard is not None else 'zlib'
+    data_file_name, index_file_name = archive_file_names(day, folder, prefix)
+    os.makedirs(os.path.dirname(data_file_name), exist_ok=True)
+
+    # the index is written last, a day without it isn't archived yet
+    if os.path.exists(index_file_name):
+        os.remove(index_file_name)
+
+    index = {'codec': codec, 'chunk_minutes': CHUNK_MINUTES, 'raw_bytes': raw_bytes, 'chunks': []}
+    with open(data_file_name, 'wb') as f:
+        for first, last, lines, chunk_text in split_into_chunks(entries):
+            data = compress(chunk_text.encode(), codec)
+            index['chunks'].append({'offset': f.tell(), 'length': len(data), 'start': str(first), 'end': str(last),
+                                    'lines': lines})
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    with open(index_file_name, 'w') as f:
+        json.dump(index, f)
+
+    # hourly files are deleted only when the archive gives back as many positions as they hold
+    index['removed'] = False
+    if remove:
+        source_rows = sum(len(read_positions_file(file_name)) for file_name in file_names)
+        if len(read_archive(day, folder, prefix=prefix)) == source_rows:
+            for file_name in file_names:
+                os.remove(file_name)
+            index['removed'] = True
+
+    return index
+
+
+def read_archive(day: date, folder: str = GPS_POSITIONS_FOLDER, start: str = None, end: str = None,
+                 lines: list = None, prefix: str = 'trams_') -> pd.DataFrame:
+    """
+    Read positions of an archived day
+    Arguments:
+        day: day of collection
+        folder: root folder of the positions archive
+        start, end: range of poll times ('YYYY-MM-DD HH:MM:SS'), None reads the whole day
+        lines: line numbers, None reads every line
+        prefix: 'trams_' or 'buses_'
+    Returns:
+        Dataframe as in trajectories.read_positions_file, only chunks which
+        overlap the time range and contain one of the lines are decompressed
+    """
+    data_file_name, index_file_name = archive_file_names(day, folder, prefix)
+    with open(index_file_name) as f:
+        index = json.load(f)
+    lines = None if lines is None else {str(line) for line in lines}
+
+    frames = []
+    with open(data_file_name, 'rb') as f:
+        for chunk in index['chunks']:
+            if start is not None and chunk['end'] < start or end is not None and chunk['start'] > end:
+                continue
+            if lines is not None and lines.isdisjoint(chunk['lines']):
+                continue
+            f.seek(chunk['offset'])
+            frames.append(parse_positions_text(decompress(f.read(chunk['length']), index['codec']).decode()))
+
+    if not frames:
+        return pd.DataFrame(columns=POSITION_COLUMNS + ['PollTime'])
+    df = pd.concat(frames, ignore_index=True)
+    if lines is not None:
+        df = df[df['Lines'].astype(str).isin(lines)]
+    if start is not None:
+        df = df[df['PollTime'] >= start]
+    if end is not None:
+        df = df[df['PollTime'] <= end]
+    return df.reset_index(drop=True)
+
+
+def days_to_compact(folder: str, before: date, prefix: str = 'trams_') -> list:
+    """
+    Find days with hourly files collected before a given day, today's files
+    are still being written and are never compacted
+    """
+    before = min(before, date.today())
+    days = set()
+    for file_name in glob.glob(os.path.join(folder, '**', f'{prefix}*_*_*_*.txt'), recursive=True):
+        found = re.search(rf'{prefix}(\d{{4}})_(\d{{1,2}})_(\d{{1,2}})_\d{{1,2}}\.txt$', file_name)
+        if found:
+            day = date(*map(int, found.groups()))
+            if day < before:
+                days.add(day)
+    return sorted(days)
+
+
+def keep_days(value: str) -> int:
+    """
+    Parse --keep-days, today is always kept
+    """
+    days = int(value)
+    if days < 1:
+        raise argparse.ArgumentTypeError('at least 1 day (today) is kept')
+    return days
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact past days of GPS positions into compressed archives')
+    parser.add_argument('--folder', default=GPS_POSITIONS_FOLDER, help='root folder of hourly txt files')
+    parser.add_argument('--prefix', default='trams_', help="'trams_' or 'buses_'")
+    parser.add_argument('--keep-days', type=keep_days, default=1,
+                        help='number of recent days left uncompacted, including today')
+    parser.add_argument('--remove', action='store_true', help='delete hourly files after compacting them')
+    args = parser.parse_args()
+
+    for day in days_to_compact(args.folder, date.today() - timedelta(days=args.keep_days - 1), args.prefix):
+        if os.path.exists(archive_file_names(day, args.folder, args.prefix)[1]) and not args.remove:
+            continue
+        index = compact_day(day, args.folder, args.prefix, args.remove)
+        compressed = sum(chunk['length'] for chunk in index['chunks'])
+        print(f'{day}: {len(index["chunks"])} chunks, {index["raw_bytes"] / 1024 ** 2:.1f} MB -> '
+              f'{compressed / 1024 ** 2:.1f} MB ({index["codec"]})')
+        if args.remove and not index['removed']:
+            print(f'{day}: the archive misses positions of the hourly files, they were kept')
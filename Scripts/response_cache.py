@@ -0,0 +1,115 @@
+import hashlib
+import sqlite3
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# query parameters which are not part of the cache key
+SECRET_PARAMETERS = {'apikey'}
+
+
+def strip_api_key(link: str) -> str:
+    """
+    Make a canonical API link without the API key
+    Arguments:
+        link: API request link
+    Returns:
+        Link with sorted query parameters and without the 'apikey' parameter
+    """
+    parts = urlsplit(link)
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if name.lower() not in SECRET_PARAMETERS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw API answers stored in a SQLite file
+
+    Answers are keyed by the endpoint and its parameters (without the API
+    key), expire after 'ttl' seconds and the least recently used ones are
+    evicted when the cache grows over 'max_bytes'. In offline mode expired
+    answers are still served, so recorded answers can be replayed without
+    the live API.
+    """
+
+    def __init__(self, file_name: str, ttl: float = 12 * 3600, max_bytes: int = 2 * 1024 ** 3,
+                 offline: bool = False):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                       key TEXT PRIMARY KEY,
+                                       url TEXT,
+                                       body BLOB,
+                                       created REAL,
+                                       accessed REAL,
+                                       size INTEGER)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+        # running total of answer sizes, so eviction doesn't sum the whole table
+        self.total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(link: str) -> str:
+        return hashlib.sha1(strip_api_key(link).encode()).hexdigest()
+
+    def get(self, link: str) -> bytes:
+        """
+        Get a cached answer for a link
+        Arguments:
+            link: API request link
+        Returns:
+            Raw body of the answer or None if it isn't cached or has expired
+        """
+        key = self.make_key(link)
+        row = self.connection.execute('SELECT body, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        body, created = row
+        now = time.time()
+        if not self.offline and now - created > self.ttl:
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.connection.commit()
+            self.total -= len(body)
+            return None
+
+        self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        self.connection.commit()
+        return body
+
+    def put(self, link: str, body: bytes):
+        """
+        Save an answer for a link and evict the least recently used answers
+        if the cache is too big
+        Arguments:
+            link: API request link
+            body: raw body of the answer
+        """
+        now = time.time()
+        key = self.make_key(link)
+        replaced = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, strip_api_key(link), body, now, now, len(body)))
+        self.total += len(body) - (replaced[0] if replaced is not None else 0)
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        """
+        Delete the least recently used answers until the cache fits in max_bytes
+        """
+        if self.total <= self.max_bytes:
+            return
+
+        to_delete = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if self.total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            self.total -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,195 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from timetables import explode_timetables
+
+# value of the schedule matrix when a trip doesn't call at a stop
+MISSING = -1
+
+# a longer pause (in minutes) between departures of a brigade starts a new trip
+TRIP_GAP = 60
+
+SCHEDULE_INDEX_FILE = 'index.json'
+
+
+class RouteSchedule:
+    """
+    Compiled timetable of one route (e.g. 'TP-KIE') of one line
+
+    Attributes:
+        times: int16 array (trips x stops) of departure times in minutes
+        since midnight, MISSING where a trip doesn't call at a stop
+        stops: stop ids ('zespol_slupek') in route order
+        brigades: brigade of every trip, trips are sorted by start time
+    """
+    __slots__ = ('times', 'stops', 'brigades', '_stop_index')
+
+    def __init__(self, times: np.ndarray, stops: np.ndarray, brigades: np.ndarray):
+        self.times = times
+        self.stops = stops
+        self.brigades = brigades
+        self._stop_index = None
+
+    def __repr__(self):
+        return f'RouteSchedule(trips={self.times.shape[0]}, stops={self.times.shape[1]})'
+
+    def stop_index(self, stop_id: str) -> int:
+        """
+        Get the column of a stop ('zespol_slupek'), -1 for stops not on the route
+        """
+        if self._stop_index is None:
+            self._stop_index = {stop: n for n, stop in enumerate(self.stops.tolist())}
+        return self._stop_index.get(stop_id, -1)
+
+    def expected_time(self, trip: int, stop: int) -> int:
+        """
+        Get the scheduled time of trip 'trip' at the stop in column 'stop'
+        """
+        return int(self.times[trip, stop])
+
+    def trips_of_brigade(self, brigade: str) -> np.ndarray:
+        """
+        Get rows of all trips of a brigade
+        """
+        return np.flatnonzero(self.brigades == brigade)
+
+
+def split_into_trips(departures: pd.DataFrame) -> np.ndarray:
+    """
+    Number single trips in a departures table
+    Arguments:
+        departures: dataframe made with explode_timetables, sorted by 'linia',
+        'trasa', 'brygada' and 'minuty'
+    Returns:
+        Array with a trip number for every departure. A brigade starts a new
+        trip when it comes back to a stop it has already visited or after a
+        pause longer than TRIP_GAP
+    """
+    keys = (departures['linia'] + '|' + departures['trasa'] + '|' + departures['brygada']).tolist()
+    stops = departures['przystanek'].tolist()
+    minutes = departures['minuty'].tolist()
+
+    trips = np.empty(len(keys), dtype=np.int64)
+    trip = -1
+    previous_key = None
+    previous_minute = 0
+    visited = set()
+    for n, (key, stop, minute) in enumerate(zip(keys, stops, minutes)):
+        if key != previous_key or stop in visited or minute - previous_minute > TRIP_GAP:
+            trip += 1
+            visited = set()
+        visited.add(stop)
+        previous_key = key
+        previous_minute = minute
+        trips[n] = trip
+
+    return trips
+
+
+def compile_route(group: pd.DataFrame) -> RouteSchedule:
+    """
+    Make a schedule matrix of a single route
+    Arguments:
+        group: departures of one route with a 'kurs' column (trip number)
+    Returns:
+        RouteSchedule of the route
+    """
+    start = group.groupby('kurs')['minuty'].transform('min')
+    offset = group['minuty'] - start
+
+    # order stops by their typical distance (in minutes) from the start of a trip
+    stop_order = offset.groupby(group['przystanek']).median().sort_values(kind='stable')
+    stops = stop_order.index.to_numpy(dtype=str)
+
+    # order trips by their start time
+    trip_start = group.groupby('kurs')['minuty'].min().sort_values(kind='stable')
+    brigades = group.groupby('kurs')['brygada'].first().loc[trip_start.index].to_numpy(dtype=str)
+
+    rows = pd.Series(np.arange(len(trip_start)), index=trip_start.index).loc[group['kurs']].to_numpy()
+    cols = pd.Series(np.arange(len(stops)), index=stop_order.index).loc[group['przystanek']].to_numpy()
+
+    times = np.full((len(trip_start), len(stops)), MISSING, dtype=np.int16)
+    times[rows, cols] = group['minuty'].to_numpy()
+
+    return RouteSchedule(times, stops, brigades)
+
+
+def compile_schedules(df: pd.DataFrame) -> dict:
+    """
+    Compile timetables into schedule matrices
+    Arguments:
+        df: timetables as saved by API_get_stops.py
+    Returns:
+        Dictionary {(line, route): RouteSchedule}, for example
+        schedules[('33', 'TP-KIE')].times[k, j] is the scheduled time of the
+        k-th trip at the j-th stop of the route
+    """
+    # explode_timetables gives back departures it's given, so they're copied before adding a column
+    departures = explode_timetables(df)
+    departures = departures.assign(przystanek=departures['zespol'] + '_' + departures['slupek'])
+    departures = departures.sort_values(['linia', 'trasa', 'brygada', 'minuty'], kind='stable')
+    departures['kurs'] = split_into_trips(departures)
+
+    return {key: compile_route(group) for key, group in departures.groupby(['linia', 'trasa'], sort=True)}
+
+
+def save_schedules(schedules: dict, folder: str):
+    """
+    Save schedule matrices to a folder
+    Arguments:
+        schedules: dictionary made with compile_schedules
+        folder: target folder, every matrix is stored in one of three npy files
+        which can be memory-mapped by load_schedules
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    index = {}
+    times_offset = stops_offset = trips_offset = 0
+    for (line, route), schedule in schedules.items():
+        n_trips, n_stops = schedule.times.shape
+        index[f'{line}|{route}'] = [times_offset, stops_offset, trips_offset, n_trips, n_stops]
+        times_offset += n_trips * n_stops
+        stops_offset += n_stops
+        trips_offset += n_trips
+
+    values = list(schedules.values())
+    times = np.concatenate([schedule.times.ravel() for schedule in values] or [np.empty(0, dtype=np.int16)])
+    stops = np.concatenate([schedule.stops for schedule in values] or [np.empty(0, dtype=str)])
+    brigades = np.concatenate([schedule.brigades for schedule in values] or [np.empty(0, dtype=str)])
+
+    np.save(os.path.join(folder, 'times.npy'), times)
+    np.save(os.path.join(folder, 'stops.npy'), stops)
+    np.save(os.path.join(folder, 'brigades.npy'), brigades)
+    with open(os.path.join(folder, SCHEDULE_INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+
+def load_schedules(folder: str, mmap: bool = True) -> dict:
+    """
+    Load schedule matrices saved with save_schedules
+    Arguments:
+        folder: folder with saved schedules
+        mmap: memory-map the matrices instead of reading them into RAM
+    Returns:
+        Dictionary {(line, route): RouteSchedule}, matrices are views of the
+        memory-mapped files, so only the pages that are looked up are read
+    """
+    mmap_mode = 'r' if mmap else None
+    times = np.load(os.path.join(folder, 'times.npy'), mmap_mode=mmap_mode)
+    stops = np.load(os.path.join(folder, 'stops.npy'), mmap_mode=mmap_mode)
+    brigades = np.load(os.path.join(folder, 'brigades.npy'), mmap_mode=mmap_mode)
+    with open(os.path.join(folder, SCHEDULE_INDEX_FILE)) as f:
+        index = json.load(f)
+
+    schedules = {}
+    for key, (times_offset, stops_offset, trips_offset, n_trips, n_stops) in index.items():
+        line, route = key.split('|', 1)
+        schedules[(line, route)] = RouteSchedule(
+            times[times_offset:times_offset + n_trips * n_stops].reshape(n_trips, n_stops),
+            stops[stops_offset:stops_offset + n_stops],
+            brigades[trips_offset:trips_offset + n_trips])
+
+    return schedules
@@ -0,0 +1,174 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from timetables import DEPARTURE_COLUMNS, explode_timetables
+
+# pyarrow is optional, without it snapshots are stored as npy columns
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+except ImportError:
+    pa = ds = None
+
+SNAPSHOT_META_FILE = '_meta.json'
+
+# typed columns of a snapshot, strings are dictionary-encoded in npy files
+DEPARTURE_DTYPES = {'linia': str, 'trasa': str, 'brygada': str, 'czas': str, 'zespol': str, 'slupek': str,
+                    'minuty': np.int16}
+STOP_DTYPES = {'zespol': str, 'slupek': str, 'nazwa_zespolu': str, 'szer_geo': float, 'dlug_geo': float,
+               'kierunek': str, 'typ': str}
+
+
+def write_snapshot(df: pd.DataFrame, folder: str, engine: str = None):
+    """
+    Save stops and timetables downloaded on one day as a columnar dataset
+    Arguments:
+        df: timetables dataframe made by API_get_stops.py
+        folder: target folder (rozklady_YYYY-MM-DD)
+        engine: 'parquet' (needs pyarrow) or 'npy', pyarrow decides by default
+    The folder holds:
+        - departures partitioned by line (one departure per row, see
+          timetables.explode_timetables), so reading one line reads only its partition
+        - stops (one stop per row) with their coordinates
+        - _meta.json with the engine and lines of the snapshot
+    """
+    engine = engine or ('parquet' if pa is not None else 'npy')
+    departures = explode_timetables(df)[DEPARTURE_COLUMNS + ['minuty']].astype(DEPARTURE_DTYPES)
+    stops = df[[column for column in STOP_DTYPES if column in df]].drop_duplicates(['zespol', 'slupek'])
+    stops = stops.astype({column: STOP_DTYPES[column] for column in stops})
+
+    os.makedirs(folder, exist_ok=True)
+    if engine == 'parquet':
+        ds.write_dataset(pa.Table.from_pandas(departures, preserve_index=False),
+                         os.path.join(folder, 'departures'), format='parquet', partitioning=line_partitioning(),
+                         existing_data_behavior='delete_matching')
+        ds.write_dataset(pa.Table.from_pandas(stops, preserve_index=False), os.path.join(folder, 'stops'),
+                         format='parquet', existing_data_behavior='delete_matching')
+    else:
+        for line, group in departures.groupby('linia', sort=True):
+            write_columns(group, os.path.join(folder, 'departures', f'linia={line}'))
+        write_columns(stops, os.path.join(folder, 'stops'))
+
+    with open(os.path.join(folder, SNAPSHOT_META_FILE), 'w') as f:
+        json.dump({'engine': engine, 'lines': sorted(departures['linia'].unique().tolist()),
+                   'departures': len(departures), 'stops': len(stops)}, f)
+
+
+def write_columns(df: pd.DataFrame, folder: str):
+    """
+    Save every column in a npy file, string columns as codes ({column}.npy)
+    and distinct values ({column}.values.npy)
+    """
+    os.makedirs(folder, exist_ok=True)
+    for column in df:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            np.save(os.path.join(folder, f'{column}.npy'), df[column].to_numpy())
+            continue
+        codes, values = pd.factorize(df[column].astype(str))
+        np.save(os.path.join(folder, f'{column}.npy'), codes.astype(np.min_scalar_type(max(len(values) - 1, 0))))
+        np.save(os.path.join(folder, f'{column}.values.npy'), values.to_numpy(dtype=str))
+
+
+def read_columns(folder: str, columns: list) -> dict:
+    """
+    Load columns saved with write_columns, memory-mapped, so only pages of
+    the requested columns are read
+    """
+    arrays = {}
+    for column in columns:
+        arrays[column] = np.load(os.path.join(folder, f'{column}.npy'), mmap_mode='r')
+        values_file = os.path.join(folder, f'{column}.values.npy')
+        if os.path.exists(values_file):
+            arrays[column] = np.load(values_file)[arrays[column]]
+    return arrays
+
+
+def read_meta(folder: str) -> dict:
+    with open(os.path.join(folder, SNAPSHOT_META_FILE)) as f:
+        return json.load(f)
+
+
+def is_snapshot(path: str) -> bool:
+    return os.path.exists(os.path.join(path, SNAPSHOT_META_FILE))
+
+
+def line_partitioning():
+    """
+    Hive partitioning by line, line numbers stay strings (e.g. '33')
+    """
+    return ds.partitioning(pa.schema([('linia', pa.string())]), flavor='hive')
+
+
+def parquet_dataset(folder: str, partitioning=None):
+    # memory-mapped, only pages of the requested columns and row groups are read
+    return ds.dataset(folder, format='parquet', partitioning=partitioning,
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def stop_key_expression():
+    """
+    Expression making 'zespol_slupek' keys of departures in pyarrow filters
+    """
+    import pyarrow.compute as pc
+    return pc.binary_join_element_wise(ds.field('zespol'), ds.field('slupek'), '_')
+
+
+def read_departures(folder: str, lines: list = None, stops: list = None, columns: list = None) -> pd.DataFrame:
+    """
+    Read departures from a snapshot made with write_snapshot
+    Arguments:
+        folder: snapshot folder
+        lines: line numbers to read, None reads every line
+        stops: (zespol, slupek) pairs to read, None reads every stop
+        columns: columns to read, None reads DEPARTURE_COLUMNS and 'minuty'
+    Returns:
+        Dataframe with one departure per row, as made by timetables.explode_timetables
+    """
+    meta = read_meta(folder)
+    columns = columns or DEPARTURE_COLUMNS + ['minuty']
+    lines = meta['lines'] if lines is None else [str(line) for line in lines if str(line) in meta['lines']]
+    read = list(dict.fromkeys(columns + (['zespol', 'slupek'] if stops is not None else [])))
+
+    if meta['engine'] == 'parquet':
+        expression = ds.field('linia').isin(lines)
+        if stops is not None:
+            keys = [f'{zespol}_{slupek}' for zespol, slupek in stops]
+            expression &= stop_key_expression().isin(keys)
+        dataset = parquet_dataset(os.path.join(folder, 'departures'), line_partitioning())
+        df = dataset.to_table(columns=read, filter=expression).to_pandas()
+    else:
+        frames = []
+        for line in lines:
+            arrays = read_columns(os.path.join(folder, 'departures', f'linia={line}'),
+                                  [column for column in read if column != 'linia'])
+            if stops is not None:
+                keys = np.char.add(np.char.add(arrays['zespol'], '_'), arrays['slupek'])
+                mask = np.isin(keys, [f'{zespol}_{slupek}' for zespol, slupek in stops])
+                arrays = {column: values[mask] for column, values in arrays.items()}
+            frame = pd.DataFrame({column: np.asarray(values) for column, values in arrays.items()})
+            if 'linia' in read:
+                frame['linia'] = line
+            frames.append(frame)
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=read)
+
+    return df[columns].astype({column: DEPARTURE_DTYPES[column] for column in columns if column in DEPARTURE_DTYPES})
+
+
+def read_stops(folder: str, columns: list = None) -> pd.DataFrame:
+    """
+    Read stops from a snapshot made with write_snapshot
+    Arguments:
+        folder: snapshot folder
+        columns: columns to read, None reads every column
+    """
+    if read_meta(folder)['engine'] == 'parquet':
+        return parquet_dataset(os.path.join(folder, 'stops')).to_table(columns=columns).to_pandas()
+
+    stops_folder = os.path.join(folder, 'stops')
+    columns = columns or [column for column in STOP_DTYPES if os.path.exists(os.path.join(stops_folder,
+                                                                                           f'{column}.npy'))]
+    return pd.DataFrame({column: np.asarray(values) for column, values in read_columns(stops_folder, columns).items()})
@@ -0,0 +1,123 @@
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+# columns of a timetable with one departure per row
+DEPARTURE_COLUMNS = ['linia', 'trasa', 'brygada', 'czas', 'zespol', 'slupek']
+
+# departures of a brigade further apart than this (in minutes) belong to different trips
+MAX_STOP_INTERVAL = 20
+
+
+def load_timetables(file_name: str) -> pd.DataFrame:
+    """
+    Load timetables saved by API_get_stops.py
+    Arguments:
+        file_name: a zip-compressed pickle (rozklady_YYYY-MM-DD.pkl), its
+        csv export (rozklady_YYYY-MM-DD.csv) or a columnar snapshot folder
+        (rozklady_YYYY-MM-DD, see snapshot_store.py)
+    Returns:
+        Timetables dataframe with dictionaries in 'linie', 'brygada' and
+        'trasa' columns, or departures (one per row) read from a snapshot folder
+    """
+    if os.path.isdir(file_name):
+        from snapshot_store import read_departures
+        return read_departures(file_name)
+
+    if file_name.endswith('.csv'):
+        df = pd.read_csv(file_name, dtype={'zespol': str, 'slupek': str})
+        for col in ['linie', 'brygada', 'trasa']:
+            if col in df:
+                df[col] = df[col].apply(ast.literal_eval)
+
+        # delete unwanted (autogenerated) column (specific for csv files)
+        if 'Unnamed: 0' in df:
+            del df['Unnamed: 0']
+        return df
+
+    return pd.read_pickle(file_name, compression='zip')
+
+
+def explode_timetables(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Make a table with one departure per row
+    Arguments:
+        df: timetables as saved by API_get_stops.py (dictionaries
+        {line: tuple} in 'linie', 'brygada' and 'trasa' columns) or as used in
+        routes_visual.ipynb (one line per row with tuples in 'czas',
+        'brygada' and 'trasa' columns)
+    Returns:
+        Dataframe with DEPARTURE_COLUMNS and an extra 'minuty' column with the
+        departure time in minutes since midnight (times after midnight, like
+        '24:06', are greater than 1440). Departures read from a snapshot
+        folder are returned as they are
+    """
+    if 'minuty' in df:
+        return df
+
+    if 'czas' in df:
+        lines = df['linie'].tolist()
+        times = df['czas'].tolist()
+        brigades = df['brygada'].tolist()
+        routes = df['trasa'].tolist()
+    else:
+        # one entry per (stop, line) pair
+        pairs = [(index, line) for index, timetable in enumerate(df['linie']) for line in timetable]
+        lines = [line for _, line in pairs]
+        times = [df['linie'].iat[index][line] for index, line in pairs]
+        brigades = [df['brygada'].iat[index][line] for index, line in pairs]
+        routes = [df['trasa'].iat[index][line] for index, line in pairs]
+        df = df.iloc[[index for index, _ in pairs]]
+
+    counts = np.array([len(entry) for entry in times], dtype=np.int64)
+
+    result = pd.DataFrame({
+        'linia': np.repeat(np.array(lines, dtype=object), counts),
+        'trasa': [route for entry in routes for route in entry],
+        'brygada': [brigade for entry in brigades for brigade in entry],
+        'czas': [time for entry in times for time in entry],
+        'zespol': np.repeat(df['zespol'].to_numpy(), counts),
+        'slupek': np.repeat(df['slupek'].to_numpy(), counts),
+    })
+    result['minuty'] = time_to_minutes(result['czas'])
+    return result
+
+
+def time_to_minutes(times: pd.Series) -> np.ndarray:
+    """
+    Convert 'HH:MM' (or 'HH:MM:SS') strings to minutes since midnight
+    Arguments:
+        times: series of strings
+    Returns:
+        Array of integers
+    """
+    hours = times.str[:2].astype(int).to_numpy()
+    minutes = times.str[3:5].astype(int).to_numpy()
+    return hours * 60 + minutes
+
+
+def stop_sequences(departures: pd.DataFrame) -> pd.DataFrame:
+    """
+    Find the order in which every route code ('trasa') of a line serves its stops
+    Arguments:
+        departures: dataframe made with explode_timetables
+    Returns:
+        Dataframe with 'linia', 'trasa', 'zespol', 'slupek' and 'Sequence'
+        (number of a stop on the route code). Departures of a brigade are
+        split into trips of one route code and stops are ordered by their
+        median time since the start of a trip
+    """
+    departures = departures.sort_values(['linia', 'brygada', 'minuty'], kind='stable')
+    lines, brigades, routes = (departures[column].to_numpy() for column in ['linia', 'brygada', 'trasa'])
+    minutes = departures['minuty'].to_numpy()
+    new_trip = np.r_[True, (lines[1:] != lines[:-1]) | (brigades[1:] != brigades[:-1]) | (routes[1:] != routes[:-1])
+                     | (np.diff(minutes) > MAX_STOP_INTERVAL)]
+    trip_start = minutes[new_trip][np.cumsum(new_trip) - 1]
+
+    elapsed = departures[['linia', 'trasa', 'zespol', 'slupek']].assign(Elapsed=minutes - trip_start)
+    result = elapsed.groupby(['linia', 'trasa', 'zespol', 'slupek'], as_index=False)['Elapsed'].median()
+    result = result.sort_values(['linia', 'trasa', 'Elapsed'], kind='stable').reset_index(drop=True)
+    result['Sequence'] = result.groupby(['linia', 'trasa']).cumcount()
+    return result[['linia', 'trasa', 'zespol', 'slupek', 'Sequence']]
@@ -0,0 +1,342 @@
+import glob
+import json
+import os
+import re
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+import shapely.geometry as geom
+
+from constants import ROUTES_EPSG, WGS84_EPSG
+
+# columns of a single vehicle entry returned by busestrams_get
+POSITION_COLUMNS = ['Lines', 'Lon', 'VehicleNumber', 'Time', 'Lat', 'Brigade']
+
+# fixes further from the poll time than this are treated as stale GPS readings
+MAX_FIX_AGE = pd.Timedelta(5, 'm')
+
+# fixes further from the route than this (in meters) are treated as off-route
+MAX_ROUTE_OFFSET = 50.0
+
+# routes are there-and-back loops, so a fix is near two legs of its route. Snapped
+# fixes of a vehicle can't move along the route faster than MAX_SPEED (m/s) or
+# back by more than MAX_BACKWARD (m, GPS noise), unless they are more than
+# MAX_SNAP_GAP seconds apart
+MAX_SPEED = 25.0
+MAX_BACKWARD = 30.0
+MAX_SNAP_GAP = 300
+
+# first line of an entry of txt files written by API_get_positions.py
+POLL_TIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+
+TO_ROUTES_CRS = pyproj.Transformer.from_crs(WGS84_EPSG, ROUTES_EPSG, always_xy=True)
+TO_WGS84 = pyproj.Transformer.from_crs(ROUTES_EPSG, WGS84_EPSG, always_xy=True)
+
+
+def position_files_for_day(day: date, gps_positions_folder: str, prefix: str = 'trams_') -> list:
+    """
+    Find every txt file with GPS positions collected on a given day
+    Arguments:
+        day: day of collection
+        gps_positions_folder: root folder of the positions archive
+        prefix: 'trams_' or 'buses_', as set by API_get_positions.py
+    Returns:
+        Sorted list of file names. Both the layout written by API_get_positions.py
+        (MONTH_YEAR/trams_YYYY_M_D_H.txt) and the notebook layout
+        (trams_DD_MM_YYYY/*.txt) are recognised
+    """
+    collector_pattern = os.path.join(gps_positions_folder, '**',
+                                     f'{prefix}{day.year}_{day.month}_{day.day}_*.txt')
+    notebook_pattern = os.path.join(gps_positions_folder, f'{prefix}{day.strftime("%d_%m_%Y")}', '*.txt')
+
+    files = set(glob.glob(collector_pattern, recursive=True)) | set(glob.glob(notebook_pattern))
+    return sorted(files)
+
+
+def read_positions_file(file_name: str) -> pd.DataFrame:
+    """
+    Read a txt file generated by API_get_positions.py
+    Arguments:
+        file_name: name of txt file
+    Returns:
+        Dataframe with every GPS fix from the file and an extra 'PollTime' column
+        holding the time the fix was downloaded
+    """
+    with open(file_name, 'r') as file:
+        return parse_positions_text(file.read())
+
+
+def positions_entries(text: str) -> list:
+    """
+    Split contents of a txt file generated by API_get_positions.py into entries
+    Returns:
+        List of tuples (poll time, JSON answer of the API). Every entry starts
+        with a poll time line, so an entry cut off by a killed collector loses
+        only itself and doesn't shift the entries after it
+    """
+    lines = text.splitlines()
+    entries = []
+    n = 0
+    while n < len(lines) - 1:
+        if POLL_TIME_PATTERN.fullmatch(lines[n]):
+            entries.append((lines[n], lines[n + 1]))
+            n += 2
+        else:
+            n += 1
+    return entries
+
+
+def parse_positions_text(text: str) -> pd.DataFrame:
+    """
+    Parse contents of a txt file generated by API_get_positions.py, or of a
+    chunk of the compressed archive (see positions_archive.py)
+    Returns:
+        Dataframe as in read_positions_file
+    """
+    records = []
+    poll_times = []
+    for poll_time, payload in positions_entries(text):
+        try:
+            result = json.loads(payload)['result']
+        except (ValueError, KeyError):
+            continue
+        # the API answers with an error message (a string) instead of a list
+        if not isinstance(result, list):
+            continue
+        records.extend(result)
+        poll_times.extend([poll_time] * len(result))
+
+    df = pd.DataFrame.from_records(records, columns=POSITION_COLUMNS)
+    df['PollTime'] = poll_times
+    return df
+
+
+def load_gps_positions(day: date, gps_positions_folder: str, lines: list = None) -> pd.DataFrame:
+    """
+    Make a clean dataframe of GPS positions collected on a given day
+    Arguments:
+        day: day of collection
+        gps_positions_folder: root folder of the positions archive
+        lines: line numbers to keep, None keeps every line
+    Returns:
+        Dataframe sorted by 'VehicleNumber' and 'Time' with parsed datetimes,
+        without duplicated and stale fixes. Days without hourly txt files are
+        read from the compressed archive made by positions_archive.py
+    """
+    frames = [read_positions_file(file_name) for file_name in position_files_for_day(day, gps_positions_folder)]
+    if not frames:
+        # compacted days are read from the compressed archive
+        from positions_archive import archive_file_names, read_archive
+        if os.path.exists(archive_file_names(day, gps_positions_folder)[1]):
+            frames = [read_archive(day, gps_positions_folder, lines=lines)]
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=POSITION_COLUMNS + ['PollTime'])
+    if lines is not None:
+        df = df[df['Lines'].isin([str(line) for line in lines])]
+
+    return clean_gps_positions(df)
+
+
+def clean_gps_positions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parse and clean raw GPS positions
+    Arguments:
+        df: dataframe made with read_positions_file
+    Returns:
+        Dataframe sorted by 'VehicleNumber' and 'Time' with parsed datetimes.
+        Every vehicle is polled many times between two GPS fixes, so repeated
+        fixes are dropped. Fixes much older than the poll time (sometimes a
+        different day or hour) are dropped as well
+    """
+    df = df.copy()
+    df['Time'] = pd.to_datetime(df['Time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    df['PollTime'] = pd.to_datetime(df['PollTime'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    df['Lon'] = df['Lon'].astype(float)
+    df['Lat'] = df['Lat'].astype(float)
+
+    df = df.dropna(subset=['Time', 'Lon', 'Lat'])
+    df = df.drop_duplicates(subset=['VehicleNumber', 'Time'])
+    df = df[(df['PollTime'] - df['Time']).abs() < MAX_FIX_AGE]
+
+    return df.sort_values(['VehicleNumber', 'Time'], kind='stable').reset_index(drop=True)
+
+
+def load_routes(lines_geometry_file_name: str, route_ids: list = None) -> dict:
+    """
+    Make route geometries given a txt file with route vertices
+    Arguments:
+        lines_geometry_file_name: name of txt file with route geometry
+        route_ids: tram line numbers to load, None loads every route
+    Returns:
+        Dictionary {line number (str): LineString in CRS 2178}. CRS 2178 is
+        metric, so lengths and distances along the routes are in meters
+    """
+    df_l = pd.read_csv(lines_geometry_file_name, sep=';')
+    df_l['route_id'] = df_l['route_id'].astype(str)
+    if route_ids is not None:
+        df_l = df_l[df_l['route_id'].isin([str(route_id) for route_id in route_ids])]
+
+    return {route_id: geom.LineString(group[['XCoord', 'YCoord']].to_numpy())
+            for route_id, group in df_l.groupby('route_id', sort=False)}
+
+
+def route_candidates(route: geom.LineString, x: np.ndarray, y: np.ndarray, max_offset: float) -> pd.DataFrame:
+    """
+    Find every part of a route a point could be snapped to
+    Arguments:
+        route: route geometry made with load_routes
+        x, y: coordinates of points in CRS 2178
+        max_offset: parts of the route further from a point are skipped
+    Returns:
+        Dataframe with 'Point' (number of a point), 'Chainage' and 'Offset' of
+        the nearest point of every stretch of the route (e.g. of every leg)
+        passing within max_offset of a point
+    """
+    coords = shapely.get_coordinates(route)
+    starts, ends = coords[:-1], coords[1:]
+    lengths = np.hypot(*(ends - starts).T)
+    chainages = np.r_[0, np.cumsum(lengths)[:-1]]
+    segments = shapely.linestrings(np.stack([starts, ends], axis=1))
+
+    point, segment = shapely.STRtree(segments).query(shapely.points(x, y), predicate='dwithin', distance=max_offset)
+    direction = ends[segment] - starts[segment]
+    relative = np.c_[x[point], y[point]] - starts[segment]
+    along = np.clip(np.sum(relative * direction, axis=1) / np.maximum(lengths[segment] ** 2, 1e-9), 0, 1)
+    offset = np.hypot(*(relative - along[:, None] * direction).T)
+    candidates = pd.DataFrame({'Point': point, 'Chainage': chainages[segment] + along * lengths[segment],
+                               'Offset': offset}).sort_values(['Point', 'Chainage'], kind='stable')
+
+    # neighbouring segments of one stretch give one candidate, the nearest one
+    chainage = candidates['Chainage'].to_numpy()
+    points = candidates['Point'].to_numpy()
+    stretch = np.cumsum(np.r_[True, (points[1:] != points[:-1]) | (np.diff(chainage) > 2 * max_offset)])
+    nearest = candidates.groupby(stretch)['Offset'].idxmin()
+    return candidates.loc[nearest].reset_index(drop=True)
+
+
+def match_candidates(candidates: pd.DataFrame, vehicles: np.ndarray, t: np.ndarray, route_length: float) -> dict:
+    """
+    Choose one candidate of every point, so snapped fixes of every vehicle
+    move forward along the route (Viterbi algorithm)
+    Arguments:
+        candidates: dataframe made with route_candidates
+        vehicles, t: vehicle and time (in seconds) of every point, points of
+                     a vehicle are sorted by time
+        route_length: length of the route in meters
+    Returns:
+        Dictionary {point: (chainage, offset)} of points with candidates.
+        The cost of a path is the sum of offsets and of distances by which
+        it moves back or faster than MAX_SPEED along the route
+    """
+    # candidates are sorted by point
+    point_ids, starts = np.unique(candidates['Point'].to_numpy(), return_index=True)
+    ends = np.r_[starts[1:], len(candidates)]
+    chainages, offsets = candidates['Chainage'].tolist(), candidates['Offset'].tolist()
+    by_point = {point: (chainages[start:end], offsets[start:end])
+                for point, start, end in zip(point_ids.tolist(), starts.tolist(), ends.tolist())}
+
+    def transition(previous_chainage, chainage, seconds):
+        if seconds > MAX_SNAP_GAP:
+            return 0.0
+        step = (chainage - previous_chainage + route_length / 2) % route_length - route_length / 2
+        return max(0.0, -step - MAX_BACKWARD) + max(0.0, step - MAX_SPEED * seconds - MAX_BACKWARD)
+
+    matched = {}
+    points = sorted(by_point)
+    n = 0
+    while n < len(points):
+        # one vehicle at a time
+        last = n
+        while last + 1 < len(points) and vehicles[points[last + 1]] == vehicles[points[n]]:
+            last += 1
+        track = points[n:last + 1]
+
+        costs = list(by_point[track[0]][1])
+        back = []
+        for previous, point in zip(track[:-1], track[1:]):
+            previous_chainages = by_point[previous][0]
+            chainages, offsets = by_point[point]
+            seconds = t[point] - t[previous]
+            new_costs, choices = [], []
+            for chainage, offset in zip(chainages, offsets):
+                options = [cost + transition(previous_chainage, chainage, seconds)
+                           for cost, previous_chainage in zip(costs, previous_chainages)]
+                best = min(range(len(options)), key=options.__getitem__)
+                new_costs.append(options[best] + offset)
+                choices.append(best)
+            costs = new_costs
+            back.append(choices)
+
+        choice = min(range(len(costs)), key=costs.__getitem__)
+        for step, point in zip(range(len(track) - 1, -1, -1), reversed(track)):
+            matched[point] = (by_point[point][0][choice], by_point[point][1][choice])
+            if step > 0:
+                choice = back[step - 1][choice]
+        n = last + 1
+    return matched
+
+
+def snap_to_route(df: pd.DataFrame, route: geom.LineString, max_offset: float = MAX_ROUTE_OFFSET) -> pd.DataFrame:
+    """
+    Snap GPS positions to a route
+    Arguments:
+        df: dataframe with 'Lon' and 'Lat' columns, with 'VehicleNumber' and
+            'Time' columns fixes of every vehicle are snapped as one track
+        route: route geometry made with load_routes
+        max_offset: fixes further from the route (in meters) are snapped to its nearest point
+    Returns:
+        Original dataframe with extra columns: 'Chainage' (distance along the
+        route in meters), 'Offset' (distance from the route in meters) and
+        'SnappedLon', 'SnappedLat' (position of the fix on the route).
+        Routes are there-and-back loops, so a fix is snapped to the leg which
+        keeps the track of its vehicle moving forward, not to the nearest one
+    """
+    df = df.copy()
+    x, y = TO_ROUTES_CRS.transform(df['Lon'].to_numpy(), df['Lat'].to_numpy())
+    points = shapely.points(x, y)
+
+    chainage = shapely.line_locate_point(route, points)
+    offset = shapely.distance(route, points)
+    if {'VehicleNumber', 'Time'} <= set(df.columns):
+        order = np.lexsort((df['Time'].to_numpy(), df['VehicleNumber'].to_numpy()))
+        t = df['Time'].to_numpy(dtype='datetime64[s]').astype(np.int64)[order].astype(float)
+        matched = match_candidates(route_candidates(route, x[order], y[order], max_offset),
+                                   df['VehicleNumber'].to_numpy()[order], t, route.length)
+        if matched:
+            ranks = np.fromiter(matched, dtype=np.int64, count=len(matched))
+            values = np.array(list(matched.values()))
+            chainage[order[ranks]] = values[:, 0]
+            offset[order[ranks]] = values[:, 1]
+    snapped = shapely.line_interpolate_point(route, chainage)
+    snapped_lon, snapped_lat = TO_WGS84.transform(shapely.get_x(snapped), shapely.get_y(snapped))
+
+    df['Chainage'] = chainage
+    df['Offset'] = offset
+    df['SnappedLon'] = snapped_lon
+    df['SnappedLat'] = snapped_lat
+    return df
+
+
+def snap_to_routes(df: pd.DataFrame, routes: dict, max_offset: float = MAX_ROUTE_OFFSET) -> pd.DataFrame:
+    """
+    Snap GPS positions of many lines to their routes
+    Arguments:
+        df: dataframe made with load_gps_positions
+        routes: dictionary made with load_routes
+        max_offset: fixes further from the route (in meters) are discarded
+    Returns:
+        Dataframe made with snap_to_route for every line with a known route,
+        in the original order
+    """
+    frames = [snap_to_route(group, routes[line], max_offset) for line, group in df.groupby('Lines', sort=False)
+              if line in routes]
+    if frames:
+        df_s = pd.concat(frames).sort_index()
+    else:
+        df_s = df.iloc[:0].assign(Chainage=np.nan, Offset=np.nan, SnappedLon=np.nan, SnappedLat=np.nan)
+    return df_s[df_s['Offset'] <= max_offset]
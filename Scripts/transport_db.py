@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+# pandas and modules built on it are imported only by methods which need
+# them, so the collectors save positions without loading pandas
+import math
+import sqlite3
+from datetime import datetime
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS positions (
+    vehicle TEXT,
+    line TEXT,
+    brigade TEXT,
+    time TEXT,                -- 'YYYY-MM-DD HH:MM:SS'
+    lat REAL,
+    lon REAL,
+    PRIMARY KEY (vehicle, time)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS positions_line_time ON positions (line, time);
+
+-- spatial-temporal index of positions, filled by insert_positions
+CREATE TABLE IF NOT EXISTS position_cells (
+    cell INTEGER,             -- grid cell, see position_cell
+    bucket INTEGER,           -- time bucket, see time_bucket
+    vehicle TEXT,
+    time TEXT,
+    PRIMARY KEY (cell, bucket, vehicle, time)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stops (
+    snapshot TEXT,            -- 'YYYY-MM-DD', day of the timetables download
+    zespol TEXT,
+    slupek TEXT,
+    nazwa_zespolu TEXT,
+    szer_geo REAL,
+    dlug_geo REAL,
+    kierunek TEXT,
+    typ TEXT,
+    PRIMARY KEY (snapshot, zespol, slupek)
+);
+
+CREATE TABLE IF NOT EXISTS timetables (
+    snapshot TEXT,
+    line TEXT,
+    route TEXT,
+    brigade TEXT,
+    zespol TEXT,
+    slupek TEXT,
+    scheduled INTEGER         -- minutes since midnight
+);
+CREATE INDEX IF NOT EXISTS timetables_stop ON timetables (line, zespol, slupek, snapshot, scheduled);
+
+CREATE TABLE IF NOT EXISTS delays (
+    day TEXT,                 -- 'YYYY-MM-DD'
+    line TEXT,
+    brigade TEXT,
+    vehicle TEXT,
+    zespol TEXT,
+    slupek TEXT,
+    scheduled INTEGER,        -- minutes since midnight
+    delay REAL,               -- seconds, negative when early
+    PRIMARY KEY (day, line, brigade, zespol, slupek, scheduled)
+);
+CREATE INDEX IF NOT EXISTS delays_stop ON delays (line, zespol, slupek, scheduled, day);
+'''
+
+# seconds a write waits for another connection (e.g. the other collector) to finish
+BUSY_TIMEOUT = 60.0
+
+# grid of the spatial index, cells are about 220 x 200 m in Warsaw
+GRID_ORIGIN = (20.6, 51.9)  # longitude, latitude of the south-west corner
+GRID_CELL = (0.003, 0.002)  # cell size in degrees of longitude and latitude
+GRID_COLUMNS = 400
+
+# length of time buckets of the spatial index, in minutes
+BUCKET_MINUTES = 15
+
+
+def grid_position(lon: float, lat: float) -> tuple:
+    """
+    Get (row, column) of a grid cell, positions outside the grid columns
+    share the cells at its edges
+    """
+    column = math.floor((lon - GRID_ORIGIN[0]) / GRID_CELL[0])
+    return math.floor((lat - GRID_ORIGIN[1]) / GRID_CELL[1]), min(max(column, 0), GRID_COLUMNS - 1)
+
+
+def position_cell(lon: float, lat: float) -> int:
+    row, column = grid_position(lon, lat)
+    return row * GRID_COLUMNS + column
+
+
+def time_bucket(time: str) -> int:
+    """
+    Get the number of a BUCKET_MINUTES long time bucket of a datetime ('YYYY-MM-DD HH:MM:SS')
+    """
+    time = datetime.fromisoformat(time)
+    return (time.toordinal() * 1440 + time.hour * 60 + time.minute) // BUCKET_MINUTES
+
+
+class TransportDB:
+    """
+    Embedded SQLite database with positions, stops, timetables and delays
+
+    The collectors append to it as they download data and analyses query it
+    through indexes, without loading whole pickles or txt files into memory.
+    The database works in WAL mode, so it can be queried while a collector
+    writes to it.
+    """
+
+    def __init__(self, file_name: str, timeout: float = BUSY_TIMEOUT):
+        self.connection = sqlite3.connect(file_name, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    ### Writing ###
+
+    def insert_positions(self, result: list):
+        """
+        Save vehicle positions and their grid cells and time buckets, repeated
+        fixes are skipped
+        Arguments:
+            result: 'result' list of a busestrams_get answer
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO positions VALUES (?, ?, ?, ?, ?, ?)',
+                [(entry['VehicleNumber'], entry['Lines'], entry['Brigade'], entry['Time'], entry['Lat'], entry['Lon'])
+                 for entry in result])
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO position_cells VALUES (?, ?, ?, ?)',
+                [(position_cell(entry['Lon'], entry['Lat']), time_bucket(entry['Time']), entry['VehicleNumber'],
+                  entry['Time']) for entry in result])
+
+    def index_positions(self, rebuild: bool = False, batch_size: int = 100000):
+        """
+        Fill the spatial-temporal index with positions saved before it existed
+        Arguments:
+            rebuild: empty the index first, needed when GRID_* or BUCKET_MINUTES change
+            batch_size: number of positions indexed in one transaction
+        """
+        if rebuild:
+            with self.connection:
+                self.connection.execute('DELETE FROM position_cells')
+        cursor = self.connection.execute('SELECT vehicle, time, lat, lon FROM positions')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO position_cells VALUES (?, ?, ?, ?)',
+                    [(position_cell(lon, lat), time_bucket(time), vehicle, time) for vehicle, time, lat, lon in rows])
+
+    def import_positions_files(self, file_names: list):
+        """
+        Save positions from txt files written by API_get_positions.py
+        Arguments:
+            file_names: list of txt file names
+        """
+        # trajectories needs shapely and pyproj, which the collectors don't
+        from trajectories import read_positions_file
+
+        for file_name in file_names:
+            df = read_positions_file(file_name)
+            self.insert_positions(df.to_dict('records'))
+
+    def insert_snapshot(self, snapshot: str, df: pd.DataFrame):
+        """
+        Save stops and timetables downloaded on one day, replacing a previous
+        download from the same day
+        Arguments:
+            snapshot: day of download ('YYYY-MM-DD')
+            df: timetables dataframe made by API_get_stops.py
+        """
+        from timetables import explode_timetables
+
+        stops = df[['zespol', 'slupek', 'nazwa_zespolu', 'szer_geo', 'dlug_geo', 'kierunek', 'typ']]
+        departures = explode_timetables(df)
+
+        with self.connection:
+            self.connection.execute('DELETE FROM stops WHERE snapshot = ?', (snapshot,))
+            self.connection.execute('DELETE FROM timetables WHERE snapshot = ?', (snapshot,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(snapshot, *row) for row in stops.itertuples(index=False)])
+            self.connection.executemany(
+                'INSERT INTO timetables VALUES (?, ?, ?, ?, ?, ?, ?)',
+                zip([snapshot] * len(departures), departures['linia'], departures['trasa'], departures['brygada'],
+                    departures['zespol'], departures['slupek'], departures['minuty'].tolist()))
+
+    def insert_delays(self, df: pd.DataFrame):
+        """
+        Save delays computed for one or more days
+        Arguments:
+            df: dataframe with 'day', 'line', 'brigade', 'vehicle', 'zespol',
+            'slupek', 'scheduled' (minutes since midnight) and 'delay' (seconds)
+            columns
+        """
+        columns = ['day', 'line', 'brigade', 'vehicle', 'zespol', 'slupek', 'scheduled', 'delay']
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO delays VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        df[columns].itertuples(index=False))
+
+    ### Querying ###
+
+    def query(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        """
+        Run any SQL query and get the result as a dataframe
+        """
+        import pandas as pd
+
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def positions(self, line: str, start: str, end: str) -> pd.DataFrame:
+        """
+        Get positions of a line between two datetimes ('YYYY-MM-DD HH:MM:SS')
+        """
+        return self.query('SELECT * FROM positions WHERE line = ? AND time BETWEEN ? AND ? ORDER BY vehicle, time',
+                          (str(line), start, end))
+
+    def positions_in_area(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float, start: str,
+                          end: str, lines: list = None) -> pd.DataFrame:
+        """
+        Get positions inside a bounding box between two datetimes, e.g. trams
+        which passed Rondo ONZ between 7 and 8, through the spatial-temporal index
+        Arguments:
+            min_lon, min_lat, max_lon, max_lat: bounding box (WGS84)
+            start, end: range of datetimes ('YYYY-MM-DD HH:MM:SS')
+            lines: line numbers, None gives every line
+        Returns:
+            Dataframe with columns of the positions table, sorted by vehicle and time
+        """
+        first_row, first_column = grid_position(min_lon, min_lat)
+        last_row, last_column = grid_position(max_lon, max_lat)
+        # cells are listed one by one (integers made here, not user input), so every cell is a seek
+        # on (cell, bucket) and only the requested time buckets are read
+        cells = ', '.join(str(row * GRID_COLUMNS + column) for row in range(first_row, last_row + 1)
+                          for column in range(first_column, last_column + 1))
+        # CROSS JOIN keeps the index table as the outer loop
+        sql = ('SELECT p.* FROM position_cells c CROSS JOIN positions p ON p.vehicle = c.vehicle AND p.time = c.time '
+               f'WHERE c.cell IN ({cells}) AND c.bucket BETWEEN ? AND ? AND c.time BETWEEN ? AND ? '
+               'AND p.lon BETWEEN ? AND ? AND p.lat BETWEEN ? AND ?')
+        params = [time_bucket(start), time_bucket(end), start, end, min_lon, max_lon, min_lat, max_lat]
+        if lines is not None:
+            sql += f' AND p.line IN ({", ".join("?" * len(lines))})'
+            params += [str(line) for line in lines]
+        return self.query(sql + ' ORDER BY p.vehicle, p.time', tuple(params))
+
+    def vehicles_in_area(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float, start: str,
+                         end: str, lines: list = None) -> pd.DataFrame:
+        """
+        Get vehicles which were inside a bounding box between two datetimes,
+        see positions_in_area
+        Returns:
+            Dataframe with 'vehicle', 'line', 'brigade', 'first' and 'last'
+            time of a fix in the box and number of 'fixes'
+        """
+        df = self.positions_in_area(min_lon, min_lat, max_lon, max_lat, start, end, lines)
+        return df.groupby(['vehicle', 'line', 'brigade'], as_index=False).agg(
+            first=('time', 'min'), last=('time', 'max'), fixes=('time', 'size'))
+
+    def timetable(self, line: str, zespol: str, slupek: str, snapshot: str) -> pd.DataFrame:
+        """
+        Get departures of a line from a stop in the timetables downloaded on 'snapshot'
+        """
+        return self.query('SELECT * FROM timetables WHERE line = ? AND zespol = ? AND slupek = ? AND snapshot = ? '
+                          'ORDER BY scheduled', (str(line), zespol, slupek, snapshot))
+
+    def average_delay(self, line: str, zespol: str, slupek: str, start: str = '00:00', end: str = '24:00',
+                      first_day: str = '0000-00-00', last_day: str = '9999-99-99') -> tuple:
+        """
+        Get the average delay of a line at a stop in a time of day window
+        Arguments:
+            line: line number, e.g. '33'
+            zespol, slupek: stop ids
+            start, end: time of day window ('HH:MM'), e.g. '07:00' and '09:00'
+            first_day, last_day: range of days ('YYYY-MM-DD')
+        Returns:
+            Tuple (average delay in seconds, number of departures)
+        """
+        import pandas as pd
+        from timetables import time_to_minutes
+
+        start, end = time_to_minutes(pd.Series([start, end]))
+        return self.connection.execute(
+            'SELECT AVG(delay), COUNT(*) FROM delays '
+            'WHERE line = ? AND zespol = ? AND slupek = ? AND scheduled >= ? AND scheduled < ? AND day BETWEEN ? AND ?',
+            (str(line), zespol, slupek, int(start), int(end), first_day, last_day)).fetchone()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from constants import GPS_POSITIONS_FOLDER, ROUTES_GEOMETRY_FILE
+from headways import MAX_GAP, add_progress
+from trajectories import MAX_BACKWARD, load_gps_positions, load_routes, snap_to_routes
+
+# length of a time of day bin in minutes
+BIN_MINUTES = 15
+N_BINS = 24 * 60 // BIN_MINUTES
+
+# segment length in meters when a route has no stop chainages
+SEGMENT_LENGTH = 500.0
+
+# travel time histogram used as a quantile sketch: log-spaced buckets from 5 s to 2 h
+SKETCH_EDGES = np.geomspace(5, 7200, 32)
+
+PROFILES_INDEX_FILE = 'index.json'
+
+
+def uniform_boundaries(route_length: float, segment_length: float = SEGMENT_LENGTH) -> np.ndarray:
+    """
+    Split a route into segments of equal length
+    Returns:
+        Chainages of segment starts, the last segment ends at the end of the route
+    """
+    return np.arange(0, route_length, segment_length)
+
+
+def boundary_passings(df: pd.DataFrame, route_length: float, boundaries: np.ndarray) -> pd.DataFrame:
+    """
+    Find times when vehicles of one line passed given points of their route
+    Arguments:
+        df: snapped positions of one line sorted by 'VehicleNumber' and 'Time'
+        route_length: length of the route in meters
+        boundaries: sorted chainages of route points (e.g. stops)
+    Returns:
+        Dataframe with one row per vehicle, lap and boundary, in the order of
+        passing: 'VehicleNumber', 'Brigade', 'Boundary' (number of a boundary),
+        'Passed' (datetime, interpolated between two fixes), 'Observed' (False
+        when the vehicle wasn't tracked there) and 'Run' (number of a run of
+        fixes without a gap longer than MAX_GAP)
+    """
+    df = add_progress(df, route_length)
+    time_zero = df['Time'].min().floor('D')
+    codes, vehicle_names = pd.factorize(df['VehicleNumber'], sort=True)
+    brigades = df.groupby(codes)['Brigade'].first().to_numpy()
+    t = (df['Time'] - time_zero).dt.total_seconds().to_numpy()
+    progress = df['Progress'].to_numpy(dtype=float)
+
+    # every boundary is passed once per lap, laps are numbered with the unwrapped progress
+    n_vehicles = len(vehicle_names)
+    first_lap = np.full(n_vehicles, np.iinfo(np.int64).max)
+    last_lap = np.full(n_vehicles, -1)
+    np.minimum.at(first_lap, codes, (progress // route_length).astype(np.int64))
+    np.maximum.at(last_lap, codes, (progress // route_length).astype(np.int64))
+    n_boundaries = len(boundaries)
+    per_vehicle = (last_lap - first_lap + 1) * n_boundaries
+    vehicle = np.repeat(np.arange(n_vehicles), per_vehicle)
+    passing = np.arange(len(vehicle)) - np.repeat(np.cumsum(per_vehicle) - per_vehicle, per_vehicle)
+    lap = np.repeat(first_lap, per_vehicle) + passing // n_boundaries
+    boundary = passing % n_boundaries
+    target = lap * route_length + boundaries[boundary]
+
+    # time of passing every boundary, interpolated between two fixes
+    offset = progress.max() + route_length + 1 if len(progress) else 1
+    flat_progress = codes * offset + progress
+    flat_target = vehicle * offset + target
+    after = np.searchsorted(flat_progress, flat_target, side='left')
+    observed = (after > 0) & (after < len(flat_progress))
+    after = np.clip(after, 1, max(len(flat_progress) - 1, 1))
+    observed &= (codes[after - 1] == vehicle) & (codes[after] == vehicle) & (t[after] - t[after - 1] <= MAX_GAP)
+    p0, p1 = flat_progress[after - 1], flat_progress[after]
+    fraction = np.where(p1 > p0, (flat_target - p0) / np.where(p1 > p0, p1 - p0, 1), 1)
+    passed = t[after - 1] + np.clip(fraction, 0, 1) * (t[after] - t[after - 1])
+
+    return pd.DataFrame({'VehicleNumber': vehicle_names[vehicle], 'Brigade': brigades[vehicle], 'Boundary': boundary,
+                         'Passed': time_zero + pd.to_timedelta(np.where(observed, passed, np.nan), unit='s'),
+                         'Observed': observed,
+                         'Run': np.cumsum(np.r_[False, np.diff(t) > MAX_GAP])[after]})
+
+
+def misplaced_passings(df: pd.DataFrame, passings: pd.DataFrame, route_length: float,
+                       boundaries: np.ndarray) -> pd.DataFrame:
+    """
+    Check boundary passings against the snapped positions they were found from
+    Arguments:
+        df: snapped positions of one line sorted by 'VehicleNumber' and 'Time'
+        passings: dataframe made with boundary_passings for these positions
+        route_length: length of the route in meters
+        boundaries: the boundaries given to boundary_passings
+    Returns:
+        Observed passings for which the fixes of the vehicle just before and
+        just after the time of passing don't enclose the boundary, e.g. when a
+        vehicle snapped to the other leg of its route shifted its progress
+    """
+    passings = passings[passings['Observed']]
+    codes, vehicle_names = pd.factorize(df['VehicleNumber'], sort=True)
+    time_zero = df['Time'].min().floor('D')
+    t = (df['Time'] - time_zero).dt.total_seconds().to_numpy()
+    chainage = df['Chainage'].to_numpy(dtype=float)
+
+    vehicle = vehicle_names.get_indexer(passings['VehicleNumber'])
+    passed = (passings['Passed'] - time_zero).dt.total_seconds().to_numpy()
+    offset = t.max() + 1 if len(t) else 1
+    before = np.clip(np.searchsorted(codes * offset + t, vehicle * offset + passed, side='right') - 1,
+                     0, max(len(t) - 2, 0))
+    after = before + 1
+
+    # the boundary lies on the forward arc from one fix to the other, give or take jitter
+    boundary = np.asarray(boundaries, dtype=float)[passings['Boundary'].to_numpy()]
+    to_boundary = (boundary - chainage[before] + MAX_BACKWARD) % route_length
+    to_next = (chainage[after] - chainage[before] + MAX_BACKWARD) % route_length
+    return passings[to_boundary > to_next + MAX_BACKWARD]
+
+
+def segment_crossings(df: pd.DataFrame, route_length: float, boundaries: np.ndarray) -> pd.DataFrame:
+    """
+    Find travel times of vehicles of one line through route segments
+    Arguments:
+        df: snapped positions of one line sorted by 'VehicleNumber' and 'Time'
+        route_length: length of the route in meters
+        boundaries: sorted chainages of segment starts (e.g. stops)
+    Returns:
+        Dataframe with 'Segment' (number of a segment), 'Start' (datetime of
+        entering it) and 'Seconds' (travel time through it)
+    """
+    passings = boundary_passings(df, route_length, boundaries)
+    vehicle = passings['VehicleNumber'].to_numpy()
+    observed = passings['Observed'].to_numpy()
+    run = passings['Run'].to_numpy()
+    passed = passings['Passed']
+
+    # a segment is travelled between passing its start and the next boundary, without missing fixes
+    complete = (observed & np.r_[observed[1:], False] & np.r_[vehicle[1:] == vehicle[:-1], False]
+                & (run == np.r_[run[1:], -1]))
+    seconds = (passed.shift(-1) - passed).dt.total_seconds()
+    return pd.DataFrame({'Segment': passings['Boundary'].to_numpy()[complete],
+                         'Start': passed.to_numpy()[complete],
+                         'Seconds': seconds.to_numpy()[complete]})
+
+
+class TravelTimeProfiles:
+    """
+    Statistics of travel times through route segments in time of day bins
+
+    Every statistic is an array (segments x bins), segments of all routes are
+    stacked one after another, so a lookup is an index computation. Days are
+    folded in one by one: a day updates counts, means and variances with
+    parallel (Chan) formulas and adds to the histograms, without rereading
+    older days.
+
+    Arguments:
+        boundaries: dictionary {route_id: chainages of segment starts}
+        allocate: make empty statistics, load sets them from files instead
+    """
+
+    def __init__(self, boundaries: dict, allocate: bool = True):
+        self.boundaries = {route_id: np.asarray(chainages, dtype=float) for route_id, chainages in boundaries.items()}
+        self.offsets = {}
+        n_segments = 0
+        for route_id, chainages in self.boundaries.items():
+            self.offsets[route_id] = n_segments
+            n_segments += len(chainages)
+
+        self.days = []
+        if allocate:
+            self.count = np.zeros((n_segments, N_BINS), dtype=np.int32)
+            self.mean = np.zeros((n_segments, N_BINS))
+            self.m2 = np.zeros((n_segments, N_BINS))
+            self.sketch = np.zeros((n_segments, N_BINS, len(SKETCH_EDGES) + 1), dtype=np.uint16)
+
+    def add(self, rows: np.ndarray, bins: np.ndarray, seconds: np.ndarray):
+        """
+        Fold travel times into the statistics
+        Arguments:
+            rows: segment rows (route offset + segment number)
+            bins: time of day bins
+            seconds: travel times
+        """
+        cells = rows * N_BINS + bins
+        size = self.count.size
+        count = np.bincount(cells, minlength=size)
+        total = np.bincount(cells, weights=seconds, minlength=size)
+        batch_mean = np.divide(total, count, out=np.zeros(size), where=count > 0)
+        batch_m2 = np.bincount(cells, weights=(seconds - batch_mean[cells]) ** 2, minlength=size)
+
+        old_count = self.count.ravel().astype(float)
+        new_count = old_count + count
+        delta = batch_mean - self.mean.ravel()
+        safe_count = np.where(new_count > 0, new_count, 1)
+        self.mean.ravel()[:] = self.mean.ravel() + delta * count / safe_count
+        self.m2.ravel()[:] = self.m2.ravel() + batch_m2 + delta ** 2 * old_count * count / safe_count
+        self.count.ravel()[:] = new_count
+
+        buckets = np.searchsorted(SKETCH_EDGES, seconds)
+        np.add.at(self.sketch.reshape(-1), cells * (len(SKETCH_EDGES) + 1) + buckets, 1)
+
+    def fold_day(self, day: str, df: pd.DataFrame, routes: dict):
+        """
+        Add travel times of one day, a day already in the profiles is skipped
+        Arguments:
+            day: day of positions ('YYYY-MM-DD')
+            df: snapped positions made with trajectories.snap_to_routes
+            routes: dictionary made with trajectories.load_routes
+        """
+        if day in self.days:
+            return
+
+        for line, group in df.groupby('Lines', sort=True):
+            if line not in routes or line not in self.boundaries:
+                continue
+            group = group.sort_values(['VehicleNumber', 'Time'], kind='stable')
+            crossings = segment_crossings(group, routes[line].length, self.boundaries[line])
+            bins = (crossings['Start'].dt.hour * 60 + crossings['Start'].dt.minute).to_numpy() // BIN_MINUTES
+            self.add(self.offsets[line] + crossings['Segment'].to_numpy(), bins, crossings['Seconds'].to_numpy())
+
+        self.days.append(day)
+
+    def row(self, route_id: str, segment: int) -> int:
+        return self.offsets[route_id] + segment
+
+    def lookup(self, route_id: str, segment: int, minutes: int) -> dict:
+        """
+        Get statistics of a segment at a time of day
+        Arguments:
+            route_id: route (line) id
+            segment: number of a segment on the route
+            minutes: time of day in minutes since midnight
+        Returns:
+            Dictionary with 'count', 'mean', 'std' and 'median' travel time in seconds
+        """
+        row, column = self.row(route_id, segment), (minutes // BIN_MINUTES) % N_BINS
+        count = int(self.count[row, column])
+        return {'count': count, 'mean': float(self.mean[row, column]),
+                'std': float(np.sqrt(self.m2[row, column] / (count - 1))) if count > 1 else float('nan'),
+                'median': self.quantile(route_id, segment, minutes, 0.5)}
+
+    def quantile(self, route_id: str, segment: int, minutes: int, q: float) -> float:
+        """
+        Get a quantile of travel time from the histogram sketch, accurate to
+        half of a histogram bucket (about 12%)
+        """
+        histogram = self.sketch[self.row(route_id, segment), (minutes // BIN_MINUTES) % N_BINS]
+        total = histogram.sum()
+        if total == 0:
+            return float('nan')
+        bucket = int(np.searchsorted(np.cumsum(histogram), q * total))
+        edges = np.r_[0, SKETCH_EDGES, SKETCH_EDGES[-1]]
+        return float((edges[bucket] + edges[bucket + 1]) / 2)
+
+    def save(self, folder: str):
+        """
+        Save the profiles to a folder, arrays can be memory-mapped by load
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name in ('count', 'mean', 'm2', 'sketch'):
+            np.save(os.path.join(folder, f'{name}.npy'), getattr(self, name))
+        index = {'days': self.days, 'boundaries': {route_id: chainages.tolist()
+                                                   for route_id, chainages in self.boundaries.items()}}
+        with open(os.path.join(folder, PROFILES_INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool = False) -> 'TravelTimeProfiles':
+        """
+        Load profiles saved with save, mmap=True gives read-only profiles for lookups
+        """
+        with open(os.path.join(folder, PROFILES_INDEX_FILE)) as f:
+            index = json.load(f)
+
+        profiles = cls(index['boundaries'], allocate=False)
+        for name in ('count', 'mean', 'm2', 'sketch'):
+            setattr(profiles, name, np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r' if mmap else None))
+        profiles.days = index['days']
+        return profiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check boundary passings of loop routes against snapped positions')
+    parser.add_argument('--day', type=date.fromisoformat, required=True, help='day of positions (YYYY-MM-DD)')
+    parser.add_argument('--lines', nargs='*', default=['13'], help='line numbers')
+    parser.add_argument('--positions-folder', default=GPS_POSITIONS_FOLDER)
+    parser.add_argument('--routes-file', default=ROUTES_GEOMETRY_FILE)
+    args = parser.parse_args()
+
+    routes = load_routes(args.routes_file, args.lines)
+    positions = snap_to_routes(load_gps_positions(args.day, args.positions_folder, args.lines), routes)
+    failed = False
+    for line, group in positions.groupby('Lines', sort=True):
+        group = group.sort_values(['VehicleNumber', 'Time'], kind='stable')
+        boundaries = uniform_boundaries(routes[line].length)
+        passings = boundary_passings(group, routes[line].length, boundaries)
+        misplaced = misplaced_passings(group, passings, routes[line].length, boundaries)
+        failed |= len(misplaced) > 0
+        print(f'{line}: {len(misplaced)} of {int(passings["Observed"].sum())} passings misplaced')
+    if failed:
+        raise SystemExit(1)